@@ -1,21 +1,36 @@
 """
 Provenance capture functions (from ctapipe and gammapy initially)
 """
+import atexit
+import copy
 import datetime
+import getpass
 import hashlib
+import importlib
+import json
 import logging
 import logging.config
+import logging.handlers
+import mmap
 import os
 import platform
+import queue
+import stat
 import sys
 import inspect
-import uuid
-from functools import wraps
+import itertools
+import threading
+import time
+import types
+import warnings
+from collections import ChainMap, OrderedDict, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
 from pathlib import Path
 import psutil
-import yaml
 
-__all__ = ["read_config", "read_definitions", "ProvCapture"]
+__all__ = ["read_config", "read_definitions", "ProvCapture", "get_capture"]
 
 _interesting_env_vars = [
     "CONDA_DEFAULT_ENV",
@@ -32,8 +47,20 @@ _interesting_env_vars = [
     "SHELL",
 ]
 
+# Fields of the resource samples (when available on the platform)
+_memory_fields = ("total", "inactive", "available", "free", "wired")
+_cpu_fields = ("user", "nice", "system", "idle")
+
 PROV_PREFIX = "_PROV_"
 SUPPORTED_HASH_TYPE = ["sha1", "sha224", "sha256", "sha384", "sha512", "md5"]  # included in hashlib
+# Faster hashes, enough for identifiers (not for authentication): blake2b is in hashlib,
+# blake3 (memory-mapped and multithreaded) and xxh3_128 require optional packages
+SUPPORTED_HASH_TYPE += ["blake2b", "blake3", "xxh3_128"]
+OPTIONAL_HASH_MODULES = {"blake3": "blake3", "xxh3_128": "xxhash"}
+# Number of file hashes and file entity ids kept in memory (least recently used are dropped)
+FILE_HASH_CACHE_SIZE = 1024
+# Ids of python objects are hash % ENTITY_ID_RANGE * 10 + modifier: they fit in a signed 64-bit integer
+ENTITY_ID_RANGE = 1 << 59
 
 logging_default_config = {
     'version': 1,
@@ -64,12 +91,16 @@ logging_default_config = {
 # To be provided at class init, here are the default values:
 logprov_default_config = {
     'capture': True,
-    'hash_type': 'sha1',
+    'hash_type': 'sha256',
     'log_filename': 'prov.log',
     'log_args': True,
     'log_args_as_entities': True,
     'log_kwargs': True,
     'log_returned_result': True,
+    'parallel_hash': True,
+    'hash_block_size': 1 << 20,
+    'log_in_background': False,
+    'dedupe_used': False,
     'system_dict': {},
     'env_vars': {},
 }
@@ -84,64 +115,404 @@ definitions_default = {
 # Read config and definitions from files (yaml)
 
 
+# Lists of parameters, usage and generation items of an activity description
+ActivitySpec = namedtuple("ActivitySpec", ["parameters", "usage", "generation"])
+_NO_ACTIVITY_SPEC = ActivitySpec((), (), ())
+
+# parsed yaml files: resolved path -> ((mtime, size), content)
+_yaml_cache = {}
+
+
+@lru_cache(maxsize=None)
+def _get_yaml_load():
+    """Helper function that imports yaml on first use and returns its load function.
+
+    The libyaml (C) parser is used when PyYAML was built with it.
+    """
+    import yaml
+
+    return partial(yaml.load, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _load_yaml(filename_path):
+    """Helper function that parses a yaml file, cached as long as the file is not modified."""
+    file_stat = filename_path.stat()
+    key = str(filename_path.resolve())
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached = _yaml_cache.get(key)
+    if cached is None or cached[0] != signature:
+        cached = (signature, _get_yaml_load()(filename_path.read_bytes()))
+        _yaml_cache[key] = cached
+    # callers get their own copy (e.g. the config is completed with default values)
+    return copy.deepcopy(cached[1])
+
+
 def read_config(filename):
     """Read yaml config file"""
     filename_path = Path(filename)
-    prov_config = yaml.safe_load(filename_path.read_text())
+    prov_config = _load_yaml(filename_path)
     return prov_config
 
 
 def read_definitions(filename):
     """Read yaml definition file"""
     filename_path = Path(filename)
-    prov_definitions = yaml.safe_load(filename_path.read_text())
+    prov_definitions = _load_yaml(filename_path)
+    _compile_definitions(prov_definitions)
     return prov_definitions
 
 
-# Capture class
+# Parse branches (python variables given in the definitions)
+
+
+@lru_cache(maxsize=None)
+def _parse_branch(branch):
+    """Split a branch string (e.g. "a.b[0].c(x=1)") into a tuple of steps.
+
+    Each step is a tuple (kind, leaf, name, args, kwargs) with kind in
+    'attr', 'call' or 'index' (args is then the index). Branches are static properties of the
+    definitions, so they are parsed once and cached.
+    """
+    steps = []
+    for leaf in branch.split("."):
+        if "(" in leaf:
+            # leaf is a function
+            leaf_elements = leaf.replace(")", "").replace(" ", "").split("(")
+            leaf_arg_list = leaf_elements.pop().split(",")
+            leaf_func = leaf_elements.pop()
+            leaf_args = []
+            leaf_kwargs = []
+            for arg in leaf_arg_list:
+                if "=" in arg:
+                    k, v = arg.split("=")
+                    leaf_kwargs.append((k, v.replace('"', "")))
+                elif arg:
+                    leaf_args.append(arg.replace('"', ""))
+            steps.append(("call", leaf, leaf_func, tuple(leaf_args), tuple(leaf_kwargs)))
+        elif "[" in leaf:
+            # leaf is list or dict
+            leaf_elements = leaf.replace("]", "").replace(" ", "").split("[")
+            leaf_index = int(leaf_elements.pop())
+            steps.append(("index", leaf, leaf_elements.pop(), leaf_index, ()))
+        else:
+            # leaf is an attribute
+            steps.append(("attr", leaf, leaf, (), ()))
+    return tuple(steps)
+
+
+def _compile_definitions(definitions):
+    """Parse all branches found in the definitions (fills the _parse_branch cache)."""
+    activity_descriptions = (definitions or {}).get("activity_descriptions") or {}
+    for activity_description in activity_descriptions.values():
+        if not activity_description:
+            continue
+        for parameter in activity_description.get("parameters") or []:
+            if "value" in parameter:
+                _parse_branch(parameter["value"])
+        items = (activity_description.get("usage") or []) + (activity_description.get("generation") or [])
+        for item_description in items:
+            subitems = [item_description]
+            for key in ["has_members", "has_progenitors"]:
+                if key in item_description:
+                    subitems.append(item_description[key])
+            for subitem in subitems:
+                for key in ["id", "value", "location", "list"]:
+                    if key in subitem:
+                        _parse_branch(subitem[key])
+
+
+@lru_cache(maxsize=None)
+def _read_static_system_provenance():
+    """Return the system provenance that is constant for the process (platform, python), computed once."""
+    bits, linkage = platform.architecture()
+    return dict(
+        executable=sys.executable,
+        platform=dict(
+            architecture_bits=bits,
+            architecture_linkage=linkage,
+            machine=platform.machine(),
+            processor=platform.processor(),
+            node=platform.node(),
+            version=str(platform.version()),
+            system=platform.system(),
+            release=platform.release(),
+            libcver=str(platform.libc_ver()),
+            num_cpus=psutil.cpu_count(),
+            boot_time=datetime.datetime.fromtimestamp(psutil.boot_time()).isoformat(),
+        ),
+        python=dict(
+            version_string=sys.version,
+            version=platform.python_version(),
+            compiler=platform.python_compiler(),
+            implementation=platform.python_implementation(),
+        ),
+    )
+
+
+def _get_static_system_provenance():
+    """Return a copy of the system provenance that is constant for the process, that the caller may modify."""
+    return copy.deepcopy(_read_static_system_provenance())
+
+
+def _json_default(obj):
+    """Return a JSON serializable version of an object unknown to the JSON encoder."""
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+def _encodable(value, depth=0):
+    """Return a value that can be serialized to JSON: values rejected by the encoder are replaced by their repr."""
+    try:
+        json.dumps(value, default=_json_default)
+        return value
+    except (TypeError, ValueError):
+        # e.g. non-string keys such as tuples, or self-referential containers
+        if isinstance(value, dict) and depth < 2:
+            return {str(k): _encodable(v, depth + 1) for k, v in value.items()}
+        return repr(value)
+
+
+# same output as orjson: compact separators, non-ASCII characters kept
+_json_encode = partial(json.dumps, default=_json_default, separators=(",", ":"), ensure_ascii=False)
+
+
+def _json_dumps(prov_dict):
+    """Serialize a record to a JSON string, never failing (logging must not break the traced function)."""
+    try:
+        return _json_encode(prov_dict)
+    except (TypeError, ValueError):
+        return _json_encode(_encodable(prov_dict))
+
+
+def _get_record_serializer():
+    """Return the function that serializes a record to a JSON string (with orjson if installed)."""
+    json_dumps = _json_dumps
+    try:
+        import orjson
+    except ImportError:
+        return json_dumps
+
+    # non-string keys are converted to strings, as json does
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(prov_dict):
+        try:
+            return orjson.dumps(prov_dict, default=_json_default, option=option).decode()
+        except orjson.JSONEncodeError:
+            # integers beyond 64 bits given by the user, tuple keys, self-referential containers
+            return json_dumps(prov_dict)
+
+    return dumps
+
+
+# date and time (to the second) of the last call to _isoformat_now()
+_now_second = (None, "")
+
+
+def _isoformat_now():
+    """Return the current local time in ISO format, only formatting the date and time once per second."""
+    global _now_second
+    sec, ns = divmod(time.time_ns(), 1_000_000_000)
+    now_second = _now_second
+    if sec != now_second[0]:
+        now_second = (sec, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec)))
+        _now_second = now_second
+    return f"{now_second[1]}.{ns // 1000:06d}"
+
+
+# Traced variables views
+
+class _TracedVariable(Mapping):
+    """Read-only view of a traced variable, over the arrays of a ProvCapture."""
+
+    _keys = ("last_id", "previous_ids", "item_description", "modifier")
+
+    def __init__(self, prov_capture, i):
+        self._prov_capture = prov_capture
+        self._i = i
+
+    def __getitem__(self, key):
+        prov_capture = self._prov_capture
+        if key == "last_id":
+            return prov_capture._tv_last_id[self._i]
+        if key == "previous_ids":
+            return list(prov_capture._tv_previous_ids[self._i])
+        if key == "item_description":
+            return prov_capture._tv_item_description[self._i]
+        if key == "modifier":
+            return prov_capture._tv_modifier[self._i]
+        raise KeyError(key)
 
-class Singleton(type):
-    """" metaclass for singleton pattern """
+    def __iter__(self):
+        return iter(self._keys)
 
-    instance = None
+    def __len__(self):
+        return len(self._keys)
 
-    def __call__(cls, *args, **kw):
-        if not cls.instance:
-            cls.instance = super().__call__(*args, **kw)
-        return cls.instance
+    def __repr__(self):
+        return repr(dict(self))
 
 
-class ProvCapture(metaclass=Singleton):
+class _TracedVariables(Mapping):
+    """Read-only view of the traced variables of a ProvCapture, use set_traced_variable() to update them."""
+
+    def __init__(self, prov_capture):
+        self._prov_capture = prov_capture
+
+    def __getitem__(self, var):
+        return _TracedVariable(self._prov_capture, self._prov_capture._tv_index[var])
+
+    def __iter__(self):
+        return iter(self._prov_capture._tv_index)
+
+    def __len__(self):
+        return len(self._prov_capture._tv_index)
+
+    def __repr__(self):
+        return repr({var: dict(traced_variable) for var, traced_variable in self.items()})
+
+
+# Capture class
+
+class ProvCapture:
+    """Capture of provenance information into a structured log.
+
+    All instances log with the shared "provLogger" logger, that each new instance configures to write to its own
+    log file: use get_capture() to create a single instance shared by the modules of an application.
+    """
 
     def __init__(self, definitions=None, config=None, get_file_id_func=None):
+        # copy, so that set_capture() or set_log_filename() do not modify the given or default config
         if config:
-            self.config = config
+            self.config = dict(config)
         else:
-            self.config = logprov_default_config
+            self.config = dict(logprov_default_config)
         # logging dict may be given in the config, otherwise, use default
         if "logging" in self.config:
             self.logging_dict = self.config["logging"]
         else:
+            # copy, so that the log file of an instance does not become the default of the next ones
+            self.logging_dict = copy.deepcopy(logging_default_config)
             if "log_filename" in self.config:
-                logging_default_config['handlers']['provHandler']['filename'] = self.config["log_filename"]
-            self.logging_dict = logging_default_config
+                self.logging_dict['handlers']['provHandler']['filename'] = self.config["log_filename"]
         # Check config and set to default if undefined
         for key in logprov_default_config:
             if key not in self.config:
                 self.config[key] = logprov_default_config[key]
         self.get_file_id_func = get_file_id_func
+        # User name (constant for the process), os.getlogin() fails when there is no controlling terminal
+        try:
+            self._agent_name = os.getenv("USER") or os.getenv("LOGNAME") or getpass.getuser()
+        except (OSError, KeyError):
+            self._agent_name = "unknown"
         # Set logger
+        self._queue_listener = None
         self.logger = self.get_logger()
+        # Hash method for file entities (config is fixed at init)
+        self._hash_method = self._resolve_hash_method()
+        self._hash_factory = self._get_hash_factory()
+        self._hash_pool = None
+        # hashes of files: (path, mtime, size, method) -> hash, reused as long as the file is not modified
+        self._file_hash_cache = OrderedDict()
+        # ids of files logged by log_file_generation: path -> ((mtime, size, entity_description), id)
+        self._entity_id_cache = OrderedDict()
+        # entity record fields fixed by each item description: id(item_description) -> (item_description, fields)
+        self._record_templates = {}
         if definitions:
             self.definitions = definitions
         else:
             self.definitions = definitions_default
         # global variables
-        self.sessions = []
-        self.traced_variables = {}
+        self.sessions = set()
+        # classes decorated with trace_methods() while capture was disabled
+        self._untraced_classes = []
+        # traced variables, stored as parallel arrays indexed by variable name
+        self._tv_index = {}
+        self._tv_last_id = []
+        self._tv_previous_ids = []
+        self._tv_item_description = []
+        self._tv_modifier = []
         self.traced_returned_results = {}
         self.usage_ids = []
         self.globals = {}
+        # records are written as JSON lines
+        self._dumps = _get_record_serializer()
+        # records of the activity being logged by each thread, written at once by flush_activity()
+        self._activity_state = threading.local()
+        # names of the environment variables to record (no duplicates)
+        self._env_var_names = tuple(dict.fromkeys(_interesting_env_vars + list(self.config["env_vars"] or [])))
+        # wall clock (UTC, ns) matching a monotonic clock reading, for cheap sample timestamps
+        self._clock_base = (time.time_ns(), time.monotonic_ns())
+        self._clock_second = (None, "")
+
+    # Definitions
+
+    @property
+    def definitions(self):
+        """Definitions of activities and entities (assign new definitions rather than modifying them in place)."""
+        return self._definitions
+
+    @definitions.setter
+    def definitions(self, definitions):
+        self._definitions = definitions
+        _compile_definitions(definitions)
+        # per activity and per entity lookups used for each traced call
+        activity_descriptions = definitions.get("activity_descriptions") or {}
+        self._activity_specs = {}
+        for name, activity_description in activity_descriptions.items():
+            activity_description = activity_description or {}
+            self._activity_specs[name] = ActivitySpec(
+                parameters=tuple(activity_description.get("parameters") or ()),
+                usage=tuple(activity_description.get("usage") or ()),
+                generation=tuple(activity_description.get("generation") or ()),
+            )
+        entity_descriptions = definitions.get("entity_descriptions") or {}
+        self._entity_type = {
+            name: entity_description["type"]
+            for name, entity_description in entity_descriptions.items()
+            if entity_description and "type" in entity_description
+        }
+
+    # Traced variables
+
+    @property
+    def traced_variables(self):
+        """Traced variables as a read-only mapping of mappings, that follows the updates of the capture."""
+        return _TracedVariables(self)
+
+    @traced_variables.setter
+    def traced_variables(self, traced_variables):
+        # read the new values first, they may be a view of the current ones
+        items = [
+            (var, tv_dict["last_id"], list(tv_dict["previous_ids"]), tv_dict["item_description"], tv_dict["modifier"])
+            for var, tv_dict in traced_variables.items()
+        ]
+        self._tv_index = {}
+        self._tv_last_id = []
+        self._tv_previous_ids = []
+        self._tv_item_description = []
+        self._tv_modifier = []
+        for item in items:
+            self.set_traced_variable(*item)
+
+    def set_traced_variable(self, var, last_id, previous_ids, item_description, modifier):
+        """Add or update a traced variable."""
+        # previous ids are kept in order as the keys of a dict, for fast lookups
+        if not isinstance(previous_ids, dict):
+            previous_ids = dict.fromkeys(previous_ids)
+        i = self._tv_index.get(var)
+        if i is None:
+            self._tv_index[var] = len(self._tv_last_id)
+            self._tv_last_id.append(last_id)
+            self._tv_previous_ids.append(previous_ids)
+            self._tv_item_description.append(item_description)
+            self._tv_modifier.append(modifier)
+        else:
+            self._tv_last_id[i] = last_id
+            self._tv_previous_ids[i] = previous_ids
+            self._tv_item_description[i] = item_description
+            self._tv_modifier[i] = modifier
 
     # Logger configuration
 
@@ -153,12 +524,58 @@ class ProvCapture(metaclass=Singleton):
             print(str(ex))
             print('Failed to set up the logger.')
             logging.basicConfig(level="INFO")
-        return logging.getLogger('provLogger')
+        logger = logging.getLogger('provLogger')
+        if self.config["log_in_background"] and logger.handlers:
+            self._start_queue_listener(logger)
+        return logger
+
+    def _start_queue_listener(self, logger):
+        """Helper function that moves the handlers of the logger to a background thread."""
+        handlers = list(logger.handlers)
+        log_queue = queue.SimpleQueue()
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._queue_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        self._queue_listener.start()
+        # write the remaining records at exit
+        atexit.register(self._queue_listener.stop)
+
+    @property
+    def _pending(self):
+        """Records of the activity being logged in this thread (None if no activity is being logged)."""
+        return getattr(self._activity_state, "pending", None)
+
+    @_pending.setter
+    def _pending(self, pending):
+        self._activity_state.pending = pending
+
+    @property
+    def _pending_date(self):
+        """Date of the records of the activity being logged in this thread."""
+        return getattr(self._activity_state, "pending_date", None)
+
+    @_pending_date.setter
+    def _pending_date(self, pending_date):
+        self._activity_state.pending_date = pending_date
 
     def set_log_filename(self, log_filename):
         """Set log filename in config and in logging dict."""
         self.config['log_filename'] = log_filename
-        self.logger.handlers[0].baseFilename = log_filename
+        handlers = self._queue_listener.handlers if self._queue_listener else self.logger.handlers
+        handlers[0].baseFilename = log_filename
+
+    def set_capture(self, capture):
+        """Enable or disable provenance capture.
+
+        Classes decorated with trace_methods() while capture was disabled are traced when it is enabled, functions
+        decorated with trace() check at each call whether capture is enabled.
+        """
+        self.config["capture"] = bool(capture)
+        if self.config["capture"]:
+            untraced_classes, self._untraced_classes = self._untraced_classes, []
+            for cls in untraced_classes:
+                self.trace_methods(cls)
 
     def log_is_active(self, scope, activity):
         """Check if provenance option is enabled in configuration settings."""
@@ -175,9 +592,14 @@ class ProvCapture(metaclass=Singleton):
 
     def trace_methods(self, cls):
         """A function decorator which decorates all methods with the trace() function."""
-        for attr in cls.__dict__:
-            if not attr.startswith('_') and callable(getattr(cls, attr)):
-                setattr(cls, attr, self.trace(getattr(cls, attr)))
+        if not self.config.get("capture"):
+            # traced by set_capture(True)
+            self._untraced_classes.append(cls)
+            return cls
+        for name, func in list(cls.__dict__.items()):
+            # only plain functions: properties, static/class methods and nested classes are left as is
+            if not name.startswith('_') and isinstance(func, types.FunctionType):
+                setattr(cls, name, self.trace(func))
         return cls
 
     def trace(self, func):
@@ -186,10 +608,22 @@ class ProvCapture(metaclass=Singleton):
         if func.__name__ not in self.definitions["activity_descriptions"]:
             self.logger.warning(f'No definition for function {func.__name__}')
             # TODO: try to create a definition automatically (may not link used/wgb entities though...)
+        # Names of args and default values of kwargs, from the function signature
+        sig_args = []
+        sig_kwargs = {}
+        for pname, p in inspect.signature(func).parameters.items():
+            if pname == "self" or p.default is p.empty:
+                sig_args.append(pname)
+            else:
+                sig_kwargs[pname] = p.default
 
         @wraps(func)
         def wrapper(*args, **kwargs):
 
+            if not self.config.get("capture"):
+                # capture disabled: nothing to prepare
+                return func(*args, **kwargs)
+
             activity = func.__name__
             activity_id = self.gen_activity_id()
             self.globals = {k: func.__globals__[k] for k in func.__globals__.keys() if k[0:1] is not '_'}
@@ -199,42 +633,50 @@ class ProvCapture(metaclass=Singleton):
                 # func is a class method, search entities in class instance self (arg[0] of the method)
                 self.logger.debug(f"{activity} is a class method")
                 # TODO: change to args[0].__dict__ ?
-                scope = args[0].__dict__
-                # scope.args = args
-                # scope.kwargs = kwargs
+                class_scope = args[0].__dict__
             else:
                 # func is a regular function, search entities in globals
-                scope = self.globals
-            scope["args"] = args
-            scope["kwargs"] = kwargs
+                class_scope = self.globals
+            # args and kwargs can be used in the definitions, without modifying the object or globals
+            scope = ChainMap({"args": args, "kwargs": kwargs}, class_scope)
 
             log_active = self.log_is_active(scope, activity)
 
             # provenance capture before execution
             if log_active:
+                # definitions of the activity, looked up once per call (definitions may be replaced)
+                spec = self._activity_specs.get(activity, _NO_ACTIVITY_SPEC)
                 derivation_records = self.get_derivation_records(scope, activity)
-                sig = inspect.signature(func)
-                usage_records = self.get_usage_records(scope, activity, activity_id)
-                parameter_records = self.get_parameters_records(scope, activity, activity_id, func_signature=sig)
+                usage_records = self.get_usage_records(scope, activity, activity_id, spec=spec)
+                parameter_records = self.get_parameters_records(
+                    scope, activity, activity_id, args, kwargs, sig_args=sig_args, sig_kwargs=sig_kwargs, spec=spec
+                )
 
             # activity execution
-            start = datetime.datetime.now().isoformat()
+            start = _isoformat_now()
             result = func(*args, **kwargs)
-            end = datetime.datetime.now().isoformat()
+            end = _isoformat_now()
 
             # provenance capture after execution
             if log_active:
                 # rk: provenance logging only if activity ends properly
-                session_id = self.log_session(scope, start)
-                for prov_record in derivation_records:
-                    self.log_prov_record(prov_record)
-                self.log_start_activity(activity, activity_id, session_id, start)
-                for prov_record in parameter_records:
-                    self.log_prov_record(prov_record)
-                for prov_record in usage_records:
-                    self.log_prov_record(prov_record)
-                self.log_generation(scope, activity, activity_id, result=result)
-                self.log_finish_activity(activity_id, end)
+                # a traced function may be called while this activity is logged (e.g. from a definition branch):
+                # the records of the enclosing activity are set aside and restored after this one is written
+                enclosing = (self._pending, self._pending_date)
+                self._pending = []
+                # one date for all the records of the activity
+                self._pending_date = _isoformat_now()
+                try:
+                    session_id = self.log_session(class_scope, start)
+                    self.log_prov_records(derivation_records)
+                    self.log_start_activity(activity, activity_id, session_id, start)
+                    self.log_prov_records(parameter_records)
+                    self.log_prov_records(usage_records)
+                    self.log_generation(scope, activity, activity_id, result=result, spec=spec)
+                    self.log_finish_activity(activity_id, end)
+                finally:
+                    self.flush_activity()
+                    self._pending, self._pending_date = enclosing
 
             return result
 
@@ -244,13 +686,15 @@ class ProvCapture(metaclass=Singleton):
 
     @staticmethod
     def gen_activity_id():
-        # uuid example: ea5caa9f-0a76-42f5-a1a7-43752df755f0
-        # uuid[-12:]: 43752df755f0
-        # uuid[-6:]: f755f0
-        return str(uuid.uuid4())[-6:]
+        # 6 hex digits, e.g. f755f0: successive values of a counter with a random start
+        return f"{next(_activity_counter) & 0xFFFFFF:06x}"
 
     def get_hash_method(self):
         """Helper function that returns hash method used."""
+        return self._hash_method
+
+    def _resolve_hash_method(self):
+        """Helper function that checks the hash method given in the config."""
         try:
             method = self.config["hash_type"].lower()
         except KeyError as ex:
@@ -258,35 +702,138 @@ class ProvCapture(metaclass=Singleton):
         if method not in SUPPORTED_HASH_TYPE:
             self.logger.warning(f"Hash method {method} not supported")
             method = "Full path"
+        if method in OPTIONAL_HASH_MODULES:
+            try:
+                importlib.import_module(OPTIONAL_HASH_MODULES[method])
+            except ImportError:
+                self.logger.warning(f"Hash method {method} requires the {OPTIONAL_HASH_MODULES[method]} package")
+                method = logprov_default_config["hash_type"]
         return method
 
-    def get_file_hash(self, path):
+    def _get_hash_factory(self):
+        """Helper function that returns the constructor of hash objects for the hash method."""
+        if self._hash_method == "blake2b":
+            # 20 bytes digest, same length as sha1
+            return partial(hashlib.blake2b, digest_size=20)
+        if self._hash_method == "blake3":
+            import blake3
+            return partial(blake3.blake3, max_threads=blake3.blake3.AUTO)
+        if self._hash_method == "xxh3_128":
+            import xxhash
+            return xxhash.xxh3_128
+        return getattr(hashlib, self._hash_method, None)
+
+    def get_file_hash(self, path, file_stat=None):
         """Helper function that returns hash of the content of a file."""
-        method = self.get_hash_method()
+        method = self._hash_method
         full_path = Path(os.path.expandvars(path))
         if method == "Full path":
             return str(full_path)
-        if full_path.is_file():
-            block_size = 65536
-            hash_func = getattr(hashlib, method)()
-            with open(full_path, "rb") as f:
-                buffer = f.read(block_size)
-                while len(buffer) > 0:
-                    hash_func.update(buffer)
-                    buffer = f.read(block_size)
-            file_hash = hash_func.hexdigest()
+        file_hash = None
+        # a stat result given by the caller saves another stat of the file
+        if file_stat is None:
+            try:
+                file_stat = full_path.stat()
+            except OSError:
+                file_stat = None
+        if file_stat and stat.S_ISREG(file_stat.st_mode):
+            # file may have been hashed in advance by hash_files(), or before and not modified since
+            key = self._file_hash_key(full_path, file_stat)
+            file_hash = self._file_hash_cache.get(key)
+            if file_hash is None:
+                file_hash = self._hash_file(full_path)
+            self._cache_file_hash(key, file_hash)
+        if file_hash is not None:
             self.logger.debug(f"File entity {path} has {method} hash {file_hash}")
             return file_hash
         else:
             self.logger.warning(f"File entity {path} not found")
             return path
 
-    def get_entity_id(self, value, item_description, var_name=""):
+    def _file_hash_key(self, full_path, file_stat):
+        """Helper function that returns the key of a file in the file hash cache."""
+        return str(full_path), file_stat.st_mtime_ns, file_stat.st_size, self._hash_method
+
+    def _cache_file_hash(self, key, file_hash):
+        """Helper function that keeps a file hash in the cache, dropping the least recently used."""
+        cache = self._file_hash_cache
+        cache[key] = file_hash
+        cache.move_to_end(key)
+        if len(cache) > FILE_HASH_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def _hash_file(self, full_path):
+        """Helper function that hashes the content of an existing file."""
+        hash_func = self._hash_factory()
+        if self._hash_method == "blake3":
+            hash_func.update_mmap(full_path)
+            return hash_func.hexdigest()
+        with open(full_path, "rb") as f:
+            try:
+                # hash the page cache directly, no copy to Python buffers
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hash_func.update(mm)
+            except (ValueError, OSError, OverflowError):
+                # empty or special file that cannot be mapped (or too large for the address space): read by blocks
+                if hasattr(hashlib, "file_digest"):
+                    # Python >= 3.11, reads into a reused buffer
+                    return hashlib.file_digest(f, self._hash_factory).hexdigest()
+                buffer = bytearray(self.config["hash_block_size"])
+                view = memoryview(buffer)
+                size = f.readinto(buffer)
+                while size:
+                    hash_func.update(view[:size])
+                    size = f.readinto(buffer)
+        return hash_func.hexdigest()
+
+    def hash_files(self, item_descriptions, resolved_items):
+        """Hash in parallel the files of File/FileCollection entities, before their ids are requested."""
+        if not self.config["parallel_hash"] or self.get_file_id_func or self._hash_method == "Full path":
+            return
+        paths = {}
+        for item_description, (properties, value) in zip(item_descriptions, resolved_items):
+            if value is None or "id" in properties:
+                continue
+            try:
+                ed_name = item_description["entity_description"]
+                ed_type = self._entity_type[ed_name]
+            except KeyError:
+                continue
+            if ed_type in ["File", "FileCollection"]:
+                full_path = Path(os.path.expandvars(self._get_entity_file(value, ed_name, ed_type)))
+                try:
+                    file_stat = full_path.stat()
+                except OSError:
+                    continue
+                # files hashed before and not modified since are taken from the cache
+                if stat.S_ISREG(file_stat.st_mode):
+                    key = self._file_hash_key(full_path, file_stat)
+                    if key not in self._file_hash_cache:
+                        paths[full_path] = key
+        if len(paths) < 2:
+            return
+        if not self._hash_pool:
+            self._hash_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+        for key, file_hash in zip(paths.values(), self._hash_pool.map(self._hash_file, paths)):
+            self._cache_file_hash(key, file_hash)
+
+    def _get_entity_file(self, value, ed_name, ed_type):
+        """Helper function that returns the file to be hashed for a File or FileCollection entity."""
+        # If FileCollection: use index file (value is the dir name)
+        if ed_type == "FileCollection":
+            index = self.definitions["entity_descriptions"][ed_name].get("index", "")
+            if Path(os.path.expandvars(value)).is_dir() and index:
+                return Path(value) / index
+        return value
+
+    def get_entity_id(self, value, item_description, var_name="", file_stat=None):
         """Helper function that guesses the id of an entity, depending on its type."""
         # Get entity description name and type
         try:
             ed_name = item_description["entity_description"]
-            ed_type = self.definitions["entity_descriptions"][ed_name]["type"]
+            ed_type = self._entity_type[ed_name]
         except KeyError as ex:
             # self.logger.warning(f"{repr(ex)} in {item_description}")
             ed_name = var_name
@@ -294,28 +841,29 @@ class ProvCapture(metaclass=Singleton):
         # TODO: add list of ed_name + function to get id
         # If FileCollection: id = index file hash (value is the dir name)
         if ed_type == "FileCollection":
-            filename = value
-            index = self.definitions["entity_descriptions"][ed_name].get("index", "")
-            if Path(os.path.expandvars(value)).is_dir() and index:
-                filename = Path(value) / index
             if self.get_file_id_func:
                 # use external function if defined
                 return self.get_file_id_func(value)
-            return self.get_file_hash(filename)
+            return self.get_file_hash(self._get_entity_file(value, ed_name, ed_type))
         # If File: id = file hash  (value is the file name)
         if ed_type == "File":
             if self.get_file_id_func:
                 # use external function if defined
                 return self.get_file_id_func(value)
-            return self.get_file_hash(value)
+            return self.get_file_hash(value, file_stat)
         # entity is not a File (so must be a PythonObject)
         try:
-            # id is defined as the hash of value (hash of the variable) plus the hash of its representation
-            entity_id = (abs(hash(value) + hash(str(value)))) * 10
+            # id is defined as the hash of value and its type
+            value_hash = hash((type(value).__name__, value))
+            if type(value).__hash__ is object.__hash__:
+                # hash based on the object identity: add the hash of its representation to follow its content
+                value_hash += hash(str(value))
+            entity_id = abs(value_hash) % ENTITY_ID_RANGE * 10
             # Add modifier for traced variables
             if "value" in item_description:
-                if item_description["value"] in self.traced_variables:
-                    entity_id += self.traced_variables[item_description["value"]]["modifier"]
+                i = self._tv_index.get(item_description["value"])
+                if i is not None:
+                    entity_id += self._tv_modifier[i]
             # Add entity_version if present (NOT USED - TO REMOVE)
             if hasattr(value, "entity_version"):
                 entity_id += getattr(value, "entity_version")
@@ -324,84 +872,69 @@ class ProvCapture(metaclass=Singleton):
             # value may not have a hash()... then use id()
             # however, two different objects may use the same memory address
             # so add hash(ed_name) to avoid issues
-            entity_id = (abs(id(value) + hash(ed_name))) * 10
+            entity_id = abs(id(value) + hash(ed_name)) % ENTITY_ID_RANGE * 10
             # Add modifier for traced variables
             if "value" in item_description:
-                if item_description["value"] in self.traced_variables:
-                    entity_id += self.traced_variables[item_description["value"]]["modifier"]
+                i = self._tv_index.get(item_description["value"])
+                if i is not None:
+                    entity_id += self._tv_modifier[i]
             return entity_id
 
     def get_nested_value(self, scope, branch):
         """Helper function that gets a specific value in a nested dictionary or class."""
-        branch_list = branch.split(".")
-        leaf = branch_list.pop(0)
-        value = None
-        if not scope:
-            # Try to find leaf in globals (no scope to explore)
-            value = self.globals.get(leaf, None)
-            if value is not None:
-                self.logger.debug(f"Found {leaf} in globals (no object or dict to search)")
+        return self._get_nested_steps(scope, _parse_branch(branch))
+
+    def _get_nested_steps(self, scope, steps):
+        """Helper function that follows parsed branch steps in a nested dictionary or class."""
+        last = len(steps) - 1
+        # debug messages are only formatted if they are logged
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for i, (kind, leaf, name, args, kwargs) in enumerate(steps):
+            value = None
+            if not scope:
+                # Try to find leaf in globals (no scope to explore)
+                value = self.globals.get(leaf, None)
+                if value is not None:
+                    if debug:
+                        self.logger.debug(f"Found {leaf} in globals (no object or dict to search)")
+                else:
+                    self.logger.warning(f"Not found: {leaf} (no object or dict to search)")
+                return value
+            # Get value of leaf in dict
+            if isinstance(scope, (dict, ChainMap)):
+                value = scope.get(leaf, None)
+                if debug and value is not None:
+                    self.logger.debug(f"Found {leaf} in a dict")
+            # Get value of leaf in object
+            elif isinstance(scope, object):
+                if kind == "call":
+                    value = getattr(scope, name, lambda *args, **kwargs: None)(*args, **dict(kwargs))
+                elif kind == "index":
+                    leaf_list = getattr(scope, name)
+                    value = getattr(leaf_list, "__getitem__", lambda *args, **kwargs: None)(args)
+                else:
+                    value = getattr(scope, name, None)
+                if debug and value is not None:
+                    self.logger.debug(f"Found {leaf} in an object")
             else:
-                self.logger.warning(f"Not found: {leaf} (no object or dict to search)")
+                raise TypeError
+            # Continue to explore branch
+            if i < last:
+                scope = value
+                continue
+            # No more branch to explore
+            if value is None:
+                # Try to find leaf in globals (not found in scope)
+                value = self.globals.get(leaf, None)
+                if value is not None:
+                    if debug:
+                        self.logger.debug(f"Found {leaf} in globals")
+                else:
+                    self.logger.warning(f"Not found: {leaf}")
             return value
-        # Get value of leaf in dict
-        if isinstance(scope, dict):
-            value = scope.get(leaf, None)
-            if value is not None:
-                self.logger.debug(f"Found {leaf} in a dict")
-        # Get value of leaf in object
-        elif isinstance(scope, object):
-            if "(" in leaf:
-                # leaf is a function
-                leaf_elements = leaf.replace(")", "").replace(" ", "").split("(")
-                leaf_arg_list = leaf_elements.pop().split(",")
-                leaf_func = leaf_elements.pop()
-                leaf_args = []
-                leaf_kwargs = {}
-                for arg in leaf_arg_list:
-                    if "=" in arg:
-                        k, v = arg.split("=")
-                        leaf_kwargs[k] = v.replace('"', "")
-                    elif arg:
-                        leaf_args.append(arg.replace('"', ""))
-                value = getattr(scope, leaf_func, lambda *args, **kwargs: None)(*leaf_args, **leaf_kwargs)
-            elif "[" in leaf:
-                # leaf is list or dict
-                leaf_elements = leaf.replace("]", "").replace(" ", "").split("[")
-                leaf_index = int(leaf_elements.pop())
-                leaf_list = getattr(scope, leaf_elements.pop())
-                value = getattr(leaf_list, "__getitem__", lambda *args, **kwargs: None)(leaf_index)
-            else:
-                # leaf is an attribute
-                value = getattr(scope, leaf, None)
-            if value is not None:
-                self.logger.debug(f"Found {leaf} in an object")
-        else:
-            raise TypeError
-        # Continue to explore branch
-        if len(branch_list):
-            branch_str = ".".join(branch_list)
-            return self.get_nested_value(value, branch_str)
-        # No more branch to explore
-        if value is None:
-            # Try to find leaf in globals (not found in scope)
-            value = self.globals.get(leaf, None)
-            if value is not None:
-                self.logger.debug(f"Found {leaf} in globals")
-            else:
-                self.logger.warning(f"Not found: {leaf}")
-        return value
 
-    def get_item_properties(self, scope, item_description):
-        """Helper function that returns properties of an entity or member."""
-        # Get entity description name and type
-        try:
-            ed_name = item_description["entity_description"]
-            ed_type = self.definitions["entity_descriptions"][ed_name]["type"]
-        except Exception as ex:
-            self.logger.warning(f"{repr(ex)} in {item_description}")
-            ed_name = ""
-            ed_type = ""
+    def resolve_item(self, scope, item_description):
+        """Helper function that resolves the id, location and value of an entity or member."""
         value = None
         properties = {}
         # item has an id to be resolved
@@ -416,14 +949,39 @@ class ProvCapture(metaclass=Singleton):
         # Copy location to value
         if value is None and "location" in properties:
             value = properties["location"]
+        return properties, value
+
+    def get_record_template(self, item_description):
+        """Helper function that returns the entity record fields given by an item description."""
+        cached = self._record_templates.get(id(item_description))
+        if cached and cached[0] is item_description:
+            return cached[1]
+        template = {}
+        if "entity_description" in item_description:
+            template["entity_description"] = item_description["entity_description"]
+        if "value" in item_description:
+            template["location"] = item_description["value"]
+        self._record_templates[id(item_description)] = (item_description, template)
+        return template
+
+    def get_item_properties(self, scope, item_description, resolved_item=None):
+        """Helper function that returns properties of an entity or member."""
+        # Get entity description name and type
+        try:
+            ed_name = item_description["entity_description"]
+            ed_type = self._entity_type[ed_name]
+        except Exception as ex:
+            self.logger.warning(f"{repr(ex)} in {item_description}")
+            ed_name = ""
+            ed_type = ""
+        properties, value = resolved_item or self.resolve_item(scope, item_description)
         # Get id from value if no id was found
         if value is not None and "id" not in properties:
             properties["id"] = self.get_entity_id(value, item_description)
             # If File/FileCollection: keep hash and hash_type as properties
             if "File" in ed_type and properties["id"] != value:
-                method = self.get_hash_method()
                 properties["hash"] = properties["id"]
-                properties["hash_type"] = method
+                properties["hash_type"] = self._hash_method
         # Add namespace if not already done
         if "namespace" in item_description:
             item_id = properties["id"]
@@ -436,9 +994,10 @@ class ProvCapture(metaclass=Singleton):
         # Keep description attributes as properties
         if ed_name:
             properties["entity_description"] = ed_name
-            for attr in ["type", "contentType"]:
-                if attr in self.definitions["entity_descriptions"][ed_name]:
-                    properties[attr] = self.definitions["entity_descriptions"][ed_name][attr]
+            entity_description = self.definitions["entity_descriptions"][ed_name]
+            for attr in ("type", "contentType"):
+                if attr in entity_description:
+                    properties[attr] = entity_description[attr]
         # Expand location to get absolute path
         if "location" in properties and properties["location"]:
             properties["location"] = os.path.expandvars(properties["location"])
@@ -446,10 +1005,36 @@ class ProvCapture(metaclass=Singleton):
 
     # Log records
 
-    def log_prov_record(self, prov_dict):
-        """Write a dictionary to the logger."""
-        record_date = datetime.datetime.now().isoformat()
-        self.logger.info(f"{PROV_PREFIX}{record_date}{PROV_PREFIX}{prov_dict}")
+    def log_prov_record(self, prov_dict, record_date=None):
+        """Write a dictionary to the logger (queued if an activity is being logged)."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            # records would be dropped by the logger, do not serialize them
+            return
+        record_date = record_date or self._pending_date or _isoformat_now()
+        record = f"{PROV_PREFIX}{record_date}{PROV_PREFIX}{self._dumps(prov_dict)}"
+        if self._pending is not None:
+            self._pending.append(record)
+        else:
+            self.logger.info(record)
+
+    def log_prov_records(self, prov_dicts):
+        """Write a list of dictionaries to the logger in a single log record (queued if an activity is being logged)."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        dumps = self._dumps
+        prefix = f"{PROV_PREFIX}{self._pending_date or _isoformat_now()}{PROV_PREFIX}"
+        records = [prefix + dumps(prov_dict) for prov_dict in prov_dicts]
+        if self._pending is not None:
+            self._pending.extend(records)
+        elif records:
+            self.logger.info("\n".join(records))
+
+    def flush_activity(self):
+        """Write the queued records of an activity in a single log record (one line per record)."""
+        pending, self._pending = self._pending, None
+        self._pending_date = None
+        if pending:
+            self.logger.info("\n".join(pending))
 
     def log_session(self, scope, start):
         """Log start of a session."""
@@ -464,7 +1049,7 @@ class ProvCapture(metaclass=Singleton):
             module_name = scope.__class__.__module__
             class_name = scope.__class__.__name__
             session_name = f"{module_name}.{class_name}"
-            self.sessions.append(session_id)
+            self.sessions.add(session_id)
             system = self.get_system_provenance()
             # TODO: add agent with os.getlogin() + relation to session
             prov_record = {
@@ -487,7 +1072,7 @@ class ProvCapture(metaclass=Singleton):
             "name": activity,
             "startTime": start,
             "in_session": session_id,
-            "agent_name": os.getlogin(),
+            "agent_name": self._agent_name,
         }
         self.log_prov_record(prov_record)
         return prov_record
@@ -503,81 +1088,74 @@ class ProvCapture(metaclass=Singleton):
 
     def get_derivation_records(self, scope, activity):
         """Get log records for potentially derived entity."""
+        traced = [(var, i) for var, i in self._tv_index.items() if var != "_returned_result"]
+        if not traced:
+            # nothing traced yet, no derivation possible
+            return []
         records = []
-        for var, tv_dict in self.traced_variables.items():
-            if var != "_returned_result":
-                entity_id = tv_dict["last_id"]
-                value = self.get_nested_value(scope, var)
-                new_id = self.get_entity_id(value, tv_dict["item_description"])
-                if new_id != entity_id:
-                    modifier = tv_dict["modifier"]
-                    previous_ids = tv_dict["previous_ids"]
-                    while new_id in previous_ids:
-                        modifier += 1
-                        new_id += 1
-                        self.logger.warning(f'id has already been taken by this variable'
-                                            f' ({var} {entity_id}): '
-                                            f'update modifier to {modifier}')
-                    previous_ids.append(new_id)
-                    self.traced_variables[var] = {
-                        "last_id": new_id,
-                        "previous_ids": previous_ids,
-                        "item_description": tv_dict["item_description"],
-                        "modifier": modifier,
-                    }
-                    # Entity record
-                    prov_record_ent = {
-                        "entity_id": new_id,
-                    }
-                    if "entity_description" in tv_dict["item_description"]:
-                        prov_record_ent.update({"entity_description": tv_dict["item_description"]["entity_description"]})
-                    if "type" in tv_dict["item_description"]:
-                        prov_record_ent.update({"type": tv_dict["item_description"]["type"]})
-                    if "value" in tv_dict["item_description"]:
-                        prov_record_ent.update({"location": tv_dict["item_description"]["value"]})
-                    if modifier:
-                        prov_record_ent.update({"modifier": modifier})
-                    records.append(prov_record_ent)
-                    # Derivation record
-                    prov_record = {
-                        "entity_id": new_id,
-                        "progenitor_id": entity_id,
-                        "generated_time": datetime.datetime.now().isoformat(),
-                    }
-                    records.append(prov_record)
-                    self.logger.warning(f"Derivation detected by {activity} for {var}. ID: {new_id}")
+        values = [self.get_nested_value(scope, var) for var, i in traced]
+        # hash the traced files in parallel, before their ids are compared
+        tv_last_id = self._tv_last_id
+        tv_item_description = self._tv_item_description
+        tv_modifier = self._tv_modifier
+        get_entity_id = self.get_entity_id
+        logger = self.logger
+        self.hash_files([tv_item_description[i] for var, i in traced], [({}, value) for value in values])
+        for (var, i), value in zip(traced, values):
+            entity_id = tv_last_id[i]
+            item_description = tv_item_description[i]
+            new_id = get_entity_id(value, item_description)
+            if new_id != entity_id:
+                modifier = tv_modifier[i]
+                previous_ids = self._tv_previous_ids[i]
+                while new_id in previous_ids:
+                    modifier += 1
+                    new_id += 1
+                    logger.warning(f'id has already been taken by this variable'
+                                   f' ({var} {entity_id}): '
+                                   f'update modifier to {modifier}')
+                previous_ids[new_id] = None
+                tv_last_id[i] = new_id
+                tv_modifier[i] = modifier
+                # Entity record
+                prov_record_ent = {
+                    "entity_id": new_id,
+                }
+                if "entity_description" in item_description:
+                    prov_record_ent["entity_description"] = item_description["entity_description"]
+                if "type" in item_description:
+                    prov_record_ent["type"] = item_description["type"]
+                if "value" in item_description:
+                    prov_record_ent["location"] = item_description["value"]
+                if modifier:
+                    prov_record_ent["modifier"] = modifier
+                records.append(prov_record_ent)
+                # Derivation record
+                prov_record = {
+                    "entity_id": new_id,
+                    "progenitor_id": entity_id,
+                    "generated_time": _isoformat_now(),
+                }
+                records.append(prov_record)
+                logger.warning(f"Derivation detected by {activity} for {var}. ID: {new_id}")
         return records
 
-    def get_parameters_records(self, scope, activity, activity_id, func_signature=None):
+    def get_parameters_records(
+        self, scope, activity, activity_id, args=(), kwargs=None, sig_args=(), sig_kwargs=None, spec=None
+    ):
         """Get log records for parameters of the activity."""
         records = []
-        parameter_list = []
         parameters = {}
-        if activity in self.definitions["activity_descriptions"]:
-            if "parameters" in self.definitions["activity_descriptions"][activity]:
-                parameter_list = self.definitions["activity_descriptions"][activity]["parameters"] or []
+        parameter_list = (spec or self._activity_specs.get(activity, _NO_ACTIVITY_SPEC)).parameters
         if parameter_list:
+            get_nested_value = self.get_nested_value
             for parameter in parameter_list:
                 if "value" in parameter:
-                    pvalue = self.get_nested_value(scope, parameter["value"])
+                    pvalue = get_nested_value(scope, parameter["value"])
                     if pvalue is not None:
                         pname = parameter.get("name", parameter["value"])
                         parameters[pname] = pvalue
-        sig_args = []
-        sig_kwargs = {}
-        if func_signature and (self.config['log_args'] or self.config['log_kwargs']):
-            for pname, p in func_signature.parameters.items():
-                if pname == "self" or p.default == p.empty:
-                    sig_args.append(pname)
-                else:
-                    sig_kwargs[pname] = p.default
         if self.config['log_args']:
-            args = []
-            # Get args in scope
-            if hasattr(scope, "args"):
-                args = scope.args
-            elif "args" in scope:
-                args = scope["args"]
             for i, pvalue in enumerate(args):
                 pname = f"args[{str(i)}]"
                 # Get name of arg from signature
@@ -598,12 +1176,8 @@ class ProvCapture(metaclass=Singleton):
                             records.append(prov_record)
                     else:
                         parameters[pname] = pvalue
-        if self.config['log_kwargs']:
-            kwargs = {}
-            if hasattr(scope, "kwargs"):
-                kwargs = scope.kwargs
-            elif "kwargs" in scope:
-                kwargs = scope["kwargs"]
+        if self.config['log_kwargs'] and sig_kwargs:
+            kwargs = kwargs or {}
             for pname, pvalue in sig_kwargs.items():
                 if pname in kwargs:
                     pvalue = kwargs[pname]
@@ -616,47 +1190,44 @@ class ProvCapture(metaclass=Singleton):
             records.append(prov_record)
         return records
 
-    def get_usage_records(self, scope, activity, activity_id):
+    def get_usage_records(self, scope, activity, activity_id, spec=None):
         """Get log records for each usage of the activity given in the definitions."""
         records = []
-        usage_list = []
-        if activity in self.definitions["activity_descriptions"]:
-            if "usage" in self.definitions["activity_descriptions"][activity]:
-                usage_list = self.definitions["activity_descriptions"][activity]["usage"] or []
+        usage_list = (spec or self._activity_specs.get(activity, _NO_ACTIVITY_SPEC)).usage
         self.usage_ids = []
-        for item_description in usage_list:
-            props = self.get_item_properties(scope, item_description)
+        resolved_items = [self.resolve_item(scope, item_description) for item_description in usage_list]
+        self.hash_files(usage_list, resolved_items)
+        get_item_properties = self.get_item_properties
+        get_record_template = self.get_record_template
+        usage_ids = self.usage_ids
+        for item_description, resolved_item in zip(usage_list, resolved_items):
+            props = get_item_properties(scope, item_description, resolved_item)
             if "id" in props:
                 entity_id = props.pop("id")
                 if "namespace" in props:
                     entity_id = props.pop("namespace") + ":" + entity_id
                 # Usage record
-                self.usage_ids.append(entity_id)
+                usage_ids.append(entity_id)
                 prov_record = {
                     "activity_id": activity_id,
                     "used_id": entity_id,
                 }
                 if "role" in item_description:
-                    prov_record.update({"used_role": item_description["role"]})
+                    prov_record["used_role"] = item_description["role"]
                 # Entity record (if not just the id)
-                prov_record_ent = {}
-                if "entity_description" in item_description:
-                    prov_record_ent.update({"entity_description": item_description["entity_description"]})
-                if "value" in item_description:
-                    prov_record_ent.update({"location": item_description["value"]})
-                for prop in props:
-                    prov_record_ent.update({prop: props[prop]})
-                if prov_record_ent:
-                    prov_record_ent.update({entity_id: entity_id})
+                entity_fields = {**get_record_template(item_description), **props}
+                if entity_fields:
+                    prov_record_ent = {
+                        "entity_id": entity_id,
+                        **entity_fields,
+                    }
                     records.append(prov_record_ent)
                 records.append(prov_record)
         return records
 
-    def log_generation(self, scope, activity, activity_id, result=None):
+    def log_generation(self, scope, activity, activity_id, result=None, spec=None):
         """Log generated entities."""
-        generation_list = []
-        if activity in self.definitions["activity_descriptions"]:
-            generation_list = self.definitions["activity_descriptions"][activity]["generation"] or []
+        generation_list = (spec or self._activity_specs.get(activity, _NO_ACTIVITY_SPEC)).generation
         returned_entity_id = None
         returned_entity_modifier = 0
         var_name = ""
@@ -666,8 +1237,8 @@ class ProvCapture(metaclass=Singleton):
             # Check if entity is in traced_variables
             # entity_id, modifier, var_name = self.check_traced_variable(entity_id)
             modifier = 0
-            for var, tv_dict in self.traced_variables.items():
-                previous_ids = tv_dict["previous_ids"]
+            for var, i in self._tv_index.items():
+                previous_ids = self._tv_previous_ids[i]
                 modifier = 0
                 if entity_id in previous_ids:
                     var_name = var
@@ -678,32 +1249,28 @@ class ProvCapture(metaclass=Singleton):
                     self.logger.warning(f'id has already been taken by a variable'
                                         f' ({var} {entity_id}): '
                                         f'update modifier to {modifier}')
-                    previous_ids.append(entity_id)
-                    self.traced_variables[var] = {
-                        "last_id": entity_id,
-                        "previous_ids": previous_ids,
-                        "item_description": tv_dict["item_description"],
-                        "modifier": modifier,
-                    }
+                    previous_ids[entity_id] = None
+                    self._tv_last_id[i] = entity_id
+                    self._tv_modifier[i] = modifier
             returned_entity_id = entity_id
             returned_entity_modifier = modifier
             log_returned_entity = True  # changed to False later if returned entity is already logged
             if not var_name:
                 # entity_id was not found in traced_variables, need to add it as _returned_result
-                if "_returned_result" in self.traced_variables:
-                    tv_dict = self.traced_variables["_returned_result"]
-                    tv_dict["last_id"] = returned_entity_id
-                    tv_dict["previous_ids"].append(returned_entity_id)
-                    tv_dict["modifier"] = 0
+                i = self._tv_index.get("_returned_result")
+                if i is not None:
+                    self._tv_last_id[i] = returned_entity_id
+                    self._tv_previous_ids[i][returned_entity_id] = None
+                    self._tv_modifier[i] = 0
                 else:
-                    self.traced_variables["_returned_result"] = {
-                        "last_id": returned_entity_id,
-                        "previous_ids": [returned_entity_id],
-                        "item_description": {},
-                        "modifier": 0,
-                    }
-        for item_description in generation_list:
-            props = self.get_item_properties(scope, item_description)
+                    self.set_traced_variable("_returned_result", returned_entity_id, [returned_entity_id], {}, 0)
+        resolved_items = [self.resolve_item(scope, item_description) for item_description in generation_list]
+        self.hash_files(generation_list, resolved_items)
+        get_item_properties = self.get_item_properties
+        tv_index = self._tv_index
+        logger = self.logger
+        for item_description, resolved_item in zip(generation_list, resolved_items):
+            props = get_item_properties(scope, item_description, resolved_item)
             if "id" in props:
                 entity_id = props.pop("id")
                 # Keep new entity as traced
@@ -711,27 +1278,22 @@ class ProvCapture(metaclass=Singleton):
                 modifier = 0
                 if "value" in item_description:
                     var = item_description["value"]
-                    if var in self.traced_variables:
-                        tv_dict = self.traced_variables[var]
-                        previous_ids = tv_dict["previous_ids"]
-                        entity_id -= tv_dict["modifier"]
-                        modifier = 0  # tv_dict["modifier"]  # try first to generate without modifier
+                    i = tv_index.get(var)
+                    if i is not None:
+                        previous_ids = self._tv_previous_ids[i]
+                        entity_id -= self._tv_modifier[i]
+                        modifier = 0  # try first to generate without modifier
                         while entity_id in previous_ids:
                             modifier += 1
                             entity_id += 1
-                            self.logger.warning(f'id has already been taken by this variable '
-                                                f'({item_description["value"]} {entity_id}): '
-                                                f'update modifier to {modifier}')
-                        previous_ids.append(entity_id)
+                            logger.warning(f'id has already been taken by this variable '
+                                           f'({item_description["value"]} {entity_id}): '
+                                           f'update modifier to {modifier}')
+                        previous_ids[entity_id] = None
                     else:
                         modifier = 0
                         previous_ids = [entity_id]
-                    self.traced_variables[item_description["value"]] = {
-                        "last_id": entity_id,
-                        "previous_ids": previous_ids,
-                        "item_description": item_description,
-                        "modifier": modifier,
-                    }
+                    self.set_traced_variable(var, entity_id, previous_ids, item_description, modifier)
                 if entity_id == returned_entity_id:
                     # returned entity is already logged from the definition
                     log_returned_entity = False
@@ -743,21 +1305,16 @@ class ProvCapture(metaclass=Singleton):
                     "generated_id": entity_id,
                 }
                 if "role" in item_description:
-                    prov_record.update({"generated_role": item_description["role"]})
+                    prov_record["generated_role"] = item_description["role"]
                 # Entity record
                 prov_record_ent = {
                     "entity_id": entity_id,
+                    **self.get_record_template(item_description),
                 }
-                if "entity_description" in item_description:
-                    prov_record_ent.update({"entity_description": item_description["entity_description"]})
-                if "value" in item_description:
-                    prov_record_ent.update({"location": item_description["value"]})
                 if modifier:
-                    prov_record_ent.update({"modifier": modifier})
-                for prop in props:
-                    prov_record_ent.update({prop: props[prop]})
-                self.log_prov_record(prov_record_ent)
-                self.log_prov_record(prov_record)
+                    prov_record_ent["modifier"] = modifier
+                prov_record_ent.update(props)
+                self.log_prov_records([prov_record_ent, prov_record])
                 if "has_members" in item_description:
                     self.log_members(entity_id, item_description["has_members"], scope)
                 if "has_progenitors" in item_description:
@@ -775,20 +1332,28 @@ class ProvCapture(metaclass=Singleton):
                 "entity_id": returned_entity_id,
             }
             if var_name:
-                prov_record_ent.update({"location": var_name})
+                prov_record_ent["location"] = var_name
             if modifier:
-                prov_record_ent.update({"modifier": returned_entity_modifier})
-            self.log_prov_record(prov_record_ent)
-            self.log_prov_record(prov_record)
+                prov_record_ent["modifier"] = returned_entity_modifier
+            self.log_prov_records([prov_record_ent, prov_record])
 
     def log_members(self, entity_id, subitem, scope):
         """Log members of and entity."""
         if "list" in subitem:
-            member_list = self.get_nested_value(scope, subitem["list"]) or []
+            member_list = self.get_nested_value(scope, subitem["list"])
+            if not member_list:
+                return
         else:
-            member_list = [scope]
-        for member in member_list:
-            props = self.get_item_properties(member, subitem)
+            member_list = (scope,)
+        records = []
+        get_item_properties = self.get_item_properties
+        # ids of the members already logged by this call (a list may contain an entity twice)
+        emitted_entity_ids = set()
+        # hash member files in parallel
+        resolved_items = [self.resolve_item(member, subitem) for member in member_list]
+        self.hash_files([subitem] * len(resolved_items), resolved_items)
+        for member, resolved_item in zip(member_list, resolved_items):
+            props = get_item_properties(member, subitem, resolved_item)
             if "id" in props:
                 mem_id = props.pop("id")
                 # Record membership
@@ -797,24 +1362,35 @@ class ProvCapture(metaclass=Singleton):
                     "member_id": mem_id,
                 }
                 # Record entity
-                prov_record_ent = {
-                    "entity_id": mem_id,
-                }
-                if "entity_description" in subitem:
-                    prov_record_ent.update({"entity_description": subitem["entity_description"]})
-                for prop in props:
-                    prov_record_ent.update({prop: props[prop]})
-                self.log_prov_record(prov_record_ent)
-                self.log_prov_record(prov_record)
+                if mem_id not in emitted_entity_ids:
+                    emitted_entity_ids.add(mem_id)
+                    prov_record_ent = {
+                        "entity_id": mem_id,
+                    }
+                    if "entity_description" in subitem:
+                        prov_record_ent["entity_description"] = subitem["entity_description"]
+                    prov_record_ent.update(props)
+                    records.append(prov_record_ent)
+                records.append(prov_record)
+        self.log_prov_records(records)
 
     def log_progenitors(self, entity_id, subitem, scope):
         """Log progenitors of and entity."""
         if "list" in subitem:
-            progenitor_list = self.get_nested_value(scope, subitem["list"]) or []
+            progenitor_list = self.get_nested_value(scope, subitem["list"])
+            if not progenitor_list:
+                return
         else:
-            progenitor_list = [scope]
-        for entity in progenitor_list:
-            props = self.get_item_properties(entity, subitem)
+            progenitor_list = (scope,)
+        records = []
+        get_item_properties = self.get_item_properties
+        # ids of the progenitors already logged by this call
+        emitted_entity_ids = set()
+        # hash progenitor files in parallel
+        resolved_items = [self.resolve_item(entity, subitem) for entity in progenitor_list]
+        self.hash_files([subitem] * len(resolved_items), resolved_items)
+        for entity, resolved_item in zip(progenitor_list, resolved_items):
+            props = get_item_properties(entity, subitem, resolved_item)
             if "id" in props:
                 progen_id = props.pop("id")
                 # Record progenitor link
@@ -823,90 +1399,104 @@ class ProvCapture(metaclass=Singleton):
                     "progenitor_id": progen_id,
                 }
                 # Record entity
-                prov_record_ent = {
-                    "entity_id": progen_id,
-                }
-                for prop in props:
-                    prov_record_ent.update({prop: props[prop]})
-                self.log_prov_record(prov_record_ent)
-                self.log_prov_record(prov_record)
+                if progen_id not in emitted_entity_ids:
+                    emitted_entity_ids.add(progen_id)
+                    prov_record_ent = {
+                        "entity_id": progen_id,
+                    }
+                    prov_record_ent.update(props)
+                    records.append(prov_record_ent)
+                records.append(prov_record)
+        self.log_prov_records(records)
+
+    def get_file_entity_id(self, file_path, entity_description, file_stat):
+        """Helper function that returns the id of a file, cached as long as the file is not modified."""
+        key = os.path.abspath(file_path)
+        signature = (file_stat.st_mtime_ns, file_stat.st_size, entity_description)
+        cache = self._entity_id_cache
+        cached = cache.get(key)
+        if cached and cached[0] == signature:
+            cache.move_to_end(key)
+            return cached[1]
+        item_description = dict(
+            file_path=file_path,
+            entity_description=entity_description,
+        )
+        entity_id = self.get_entity_id(file_path, item_description, file_stat=file_stat)
+        cache[key] = (signature, entity_id)
+        cache.move_to_end(key)
+        if len(cache) > FILE_HASH_CACHE_SIZE:
+            cache.popitem(last=False)
+        return entity_id
 
     def log_file_generation(self, file_path, entity_description="", used=None, role="", activity_name=""):
+        log_prov_record = self.log_prov_record
+        get_entity_id = self.get_entity_id
+        # ids of the used entities already logged by this call (if dedupe_used)
+        logged_used_ids = set() if self.config["dedupe_used"] else None
         # get file properties
-        if os.path.isfile(file_path):
-            item_description = dict(
-                file_path=file_path,
-                entity_description=entity_description,
-            )
-            entity_id = self.get_entity_id(file_path, item_description)
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            file_stat = None
+        if file_stat and stat.S_ISREG(file_stat.st_mode):
+            entity_id = self.get_file_entity_id(file_path, entity_description, file_stat)
             prov_record = {
                 "entity_id": entity_id,
                 "entity_description": entity_description,
                 "location": file_path,
                 "hash": entity_id,
-                "hash_type": self.config["hash_type"],
+                "hash_type": self._hash_method,
             }
-            self.log_prov_record(prov_record)
+            log_prov_record(prov_record)
             if activity_name:
                 activity_id = self.gen_activity_id()
                 prov_record = {
                     "activity_id": activity_id,
                     "name": activity_name,
                 }
-                self.log_prov_record(prov_record)
+                log_prov_record(prov_record)
                 if used:
                     for used_entity in used:
-                        used_id = self.get_entity_id(used_entity, {})
+                        used_id = get_entity_id(used_entity, {})
+                        if logged_used_ids is not None:
+                            if used_id in logged_used_ids:
+                                continue
+                            logged_used_ids.add(used_id)
                         prov_record = {
                             "activity_id": activity_id,
                             "used_id": used_id,
                         }
-                        self.log_prov_record(prov_record)
+                        log_prov_record(prov_record)
                     prov_record = {
                         "activity_id": activity_id,
                         "generated_id": entity_id,
                     }
                 if role:
-                    prov_record.update({"generated_role": role})
-                self.log_prov_record(prov_record)
+                    prov_record["generated_role"] = role
+                log_prov_record(prov_record)
             else:
                 if used:
                     for used_entity in used:
-                        used_id = self.get_entity_id(used_entity, {})
+                        used_id = get_entity_id(used_entity, {})
+                        if logged_used_ids is not None:
+                            if used_id in logged_used_ids:
+                                continue
+                            logged_used_ids.add(used_id)
                         prov_record = {
                             "entity_id": entity_id,
                             "progenitor_id": used_id,
                         }
-                        self.log_prov_record(prov_record)
+                        log_prov_record(prov_record)
 
     def get_system_provenance(self):
         """Return JSON string containing provenance for all things that are fixed during the runtime."""
-        bits, linkage = platform.architecture()
-        system_dict = dict(
-            executable=sys.executable,
-            platform=dict(
-                architecture_bits=bits,
-                architecture_linkage=linkage,
-                machine=platform.machine(),
-                processor=platform.processor(),
-                node=platform.node(),
-                version=str(platform.version()),
-                system=platform.system(),
-                release=platform.release(),
-                libcver=str(platform.libc_ver()),
-                num_cpus=psutil.cpu_count(),
-                boot_time=datetime.datetime.fromtimestamp(psutil.boot_time()).isoformat(),
-            ),
-            python=dict(
-                version_string=sys.version,
-                version=platform.python_version(),
-                compiler=platform.python_compiler(),
-                implementation=platform.python_implementation(),
-            ),
-            environment=self.get_env_vars(),
-            arguments=sys.argv,
-            start_time_utc=datetime.datetime.now().isoformat(),
-        )
+        system_dict = {
+            **_get_static_system_provenance(),
+            "environment": self.get_env_vars(),
+            "arguments": sys.argv,
+            "start_time_utc": datetime.datetime.now().isoformat(),
+        }
         # Include additional dict provided
         if 'system_dict' in self.config and self.config['system_dict']:
             system_dict.update(self.config['system_dict'])
@@ -914,29 +1504,54 @@ class ProvCapture(metaclass=Singleton):
 
     def get_env_vars(self):
         """Return env vars defined at the main scope of the script."""
-        env_vars = {}
-        for var in _interesting_env_vars:
-            env_vars[var] = os.getenv(var, None)
-        # Include additional vars requested
-        if 'env_vars' in self.config and self.config['env_vars']:
-            for var in self.config['env_vars']:
-                env_vars[var] = os.getenv(var, None)
-        return env_vars
+        environ = os.environ
+        return {var: environ.get(var) for var in self._env_var_names}
 
-    def _sample_cpu_and_memory(self):
-        # times = np.asarray(psutil.cpu_times(percpu=True))
-        # mem = psutil.virtual_memory()
+    def _utc_isoformat(self):
+        """Helper function that returns the current UTC time in ISO format without building a datetime."""
+        wall_ns, mono_ns = self._clock_base
+        sec, ns = divmod(wall_ns + time.monotonic_ns() - mono_ns, 1_000_000_000)
+        # the date/time part only changes once per second
+        if sec != self._clock_second[0]:
+            self._clock_second = (sec, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec)))
+        return f"{self._clock_second[1]}.{ns // 1000:06d}"
 
+    def _sample_cpu_and_memory(self):
+        times = psutil.cpu_times(percpu=True)
+        mem = psutil.virtual_memory()
+        # per cpu times, transposed to one list per field (fields depend on the platform)
+        cpu_times = dict(zip(times[0]._fields, map(list, zip(*times))))
         return dict(
-            time_utc=datetime.datetime.utcnow().isoformat(),
-            # memory=dict(total=mem.total,
-            #             inactive=mem.inactive,
-            #             available=mem.available,
-            #             free=mem.free,
-            #             wired=mem.wired),
-            # cpu=dict(ncpu=psutil.cpu_count(),
-            #          user=list(times[:, 0]),
-            #          nice=list(times[:, 1]),
-            #          system=list(times[:, 2]),
-            #          idle=list(times[:, 3])),
+            time_utc=self._utc_isoformat(),
+            memory={field: getattr(mem, field) for field in _memory_fields if hasattr(mem, field)},
+            cpu=dict(ncpu=len(times), **{field: cpu_times[field] for field in _cpu_fields if field in cpu_times}),
         )
+
+
+# Activity ids (24 bits): a counter is unique within the process, its random start makes
+# collisions with other processes unlikely
+_activity_counter = itertools.count(int.from_bytes(os.urandom(3), "big"))
+
+
+# Shared capture instance
+
+_capture_instance = None
+_capture_args = None
+_capture_lock = threading.Lock()
+
+
+def get_capture(*args, **kwargs):
+    """Return the shared ProvCapture instance, created with the given arguments on first call.
+
+    Arguments given to later calls are ignored, a warning is issued if they differ from those of the first call.
+    """
+    global _capture_instance, _capture_args
+    if _capture_instance is None:
+        with _capture_lock:
+            if _capture_instance is None:
+                _capture_instance = ProvCapture(*args, **kwargs)
+                _capture_args = (args, kwargs)
+                return _capture_instance
+    if (args or kwargs) and (args, kwargs) != _capture_args:
+        warnings.warn("get_capture() arguments are ignored, the shared ProvCapture already exists", stacklevel=2)
+    return _capture_instance
@@ -3,35 +3,63 @@ Provenance i/o conversion functions
 """
 
 import datetime
-import yaml
+import hashlib
+import json
+import os
+from collections import OrderedDict
 from prov.model import ProvDocument
 from voprov.models.model import VOProvDocument, VOProvBundle, VOPROV, PROV
+from .capture import _get_yaml_load
 
 PROV_PREFIX = "_PROV_"
 DEFAULT_NS = "session"
+ISO_DATE_LENGTH = len("YYYY-MM-DDTHH:MM:SS.ffffff")
+# Number of svg renderings kept in memory (least recently used are dropped)
+SVG_CACHE_SIZE = 8
 
-__all__ = ["provlist2provdoc", "provdoc2svg", "read_prov"]
+# svg content of the last rendered documents: (digest of the document, options) -> svg
+_svg_cache = OrderedDict()
+
+__all__ = ["provlist2provdoc", "provdoc2svg", "read_prov", "read_prov_range", "provlist2provfile", "provfile2provlist"]
 
 # TODO: prov with internal or external ids (no ns or ns+session)
 
 
+def _shorten(value, length=20):
+    """ Return the string of a value, truncated with an ellipsis if longer than length"""
+    value_str = str(value)
+    if len(value_str) <= length:
+        return value_str
+    return value_str[:length] + "..."
+
+
 def provlist2provdoc(provlist, default_ns=DEFAULT_NS):
     """ Convert a list of provenance dictionaries to a provdoc W3C PROV compatible"""
     pdoc = VOProvDocument()
     pdoc.set_default_namespace("param:")
     pdoc.add_namespace(default_ns, default_ns + ":")
     pdoc.add_namespace("voprov", "voprov:")
+    # prefixes of the namespaces already added to the document
+    namespaces = {default_ns, "voprov"}
     records = {}
+
+    def get_or_create(create, qid):
+        """ Return the record with the qualified id qid, created with create() if needed"""
+        record = records.get(qid)
+        if record is None:
+            record = records[qid] = create(qid)
+        return record
+
+    # constructors used for every record, bound once
+    new_entity, new_activity, new_agent = pdoc.entity, pdoc.activity, pdoc.agent
+    was_configured_by = pdoc.wasConfiguredBy
+    ns_prefix = default_ns + ":"
     sess_id = ""
     for provdict in provlist:
         if "session_id" in provdict:
             sess_id = str(provdict.pop("session_id"))
-            sess_qid = default_ns + ":" + sess_id
-            if sess_id in records:
-                sess = records[sess_qid]
-            else:
-                sess = pdoc.entity(sess_qid)
-                records[sess_qid] = sess
+            sess_qid = ns_prefix + sess_id
+            sess = get_or_create(new_entity, sess_qid)
             sess.add_attributes(
                 {
                     "prov:label": "LogProvSession",
@@ -47,12 +75,8 @@ def provlist2provdoc(provlist, default_ns=DEFAULT_NS):
         # activity
         if "activity_id" in provdict:
             act_id_short = str(provdict.pop("activity_id")).replace("-", "")
-            act_id = default_ns + ":" + "_".join([sess_id, act_id_short])
-            if act_id in records:
-                act = records[act_id]
-            else:
-                act = pdoc.activity(act_id)
-                records[act_id] = act
+            act_id = f"{ns_prefix}{sess_id}_{act_id_short}"
+            act = get_or_create(new_activity, act_id)
             # activity name
             if "name" in provdict:
                 act.add_attributes({"prov:label": provdict.pop("name")})
@@ -76,31 +100,24 @@ def provlist2provdoc(provlist, default_ns=DEFAULT_NS):
             if "agent_name" in provdict:
                 agent_id = str(provdict.pop("agent_name"))
                 if ":" not in agent_id:
-                    agent_id = default_ns + ":" + agent_id
-                else:
-                    new_ns = agent_id.split(":").pop(0)
-                    pdoc.add_namespace(new_ns, new_ns + ":")
-                if agent_id in records:
-                    agent = records[agent_id]
+                    agent_id = ns_prefix + agent_id
                 else:
-                    agent = pdoc.agent(agent_id)
-                    records[agent_id] = agent
+                    new_ns = agent_id.partition(":")[0]
+                    if new_ns not in namespaces:
+                        pdoc.add_namespace(new_ns, new_ns + ":")
+                        namespaces.add(new_ns)
+                agent = get_or_create(new_agent, agent_id)
                 act.wasAssociatedWith(agent, attributes={"prov:role": "Operator"})
             if "parameters" in provdict:
                 params_record = provdict.pop("parameters")
-                params = {
-                    k: str(params_record[k]) for k in params_record
-                }
                 # par_id = act_id + "_parameters"
                 # par = pdoc.entity(par_id, other_attributes=params)
                 # par.add_attributes({"prov:type": "Parameters"})
                 # par.add_attributes({"prov:label": "WasConfiguredBy"})
                 # act.used(par, attributes={"prov:type": "Setup"})
                 bundle_act_config = pdoc.bundle('#configuration#' + act_id_short);
-                for name, value in params.items():
-                    value_short = str(value)[:20]
-                    if len(value_short) == 20:
-                        value_short += "..."
+                for name, value in params_record.items():
+                    value_short = _shorten(value)
                     # par = pdoc.entity(act_id + "_" + name)
                     # par.add_attributes({"prov:label": name + " = " + value_short})
                     # par.add_attributes({"prov:type": "voprov:Parameter"})
@@ -108,20 +125,18 @@ def provlist2provdoc(provlist, default_ns=DEFAULT_NS):
                     # par.add_attributes({"prov:value": value_short})
                     # act.used(par, attributes={"prov:type": "Setup"})
                     par = bundle_act_config.parameter(act_id + "_" + name, name, value_short);
-                    pdoc.wasConfiguredBy(act, par, "Parameter");
+                    was_configured_by(act, par, "Parameter");
             # usage
             if "used_id" in provdict:
                 ent_id = str(provdict.pop("used_id"))
                 if ":" not in ent_id:
-                    ent_id = default_ns + ":" + "_".join([sess_id, ent_id])
-                else:
-                    new_ns = ent_id.split(":").pop(0)
-                    pdoc.add_namespace(new_ns, new_ns + ":")
-                if ent_id in records:
-                    ent = records[ent_id]
+                    ent_id = f"{ns_prefix}{sess_id}_{ent_id}"
                 else:
-                    ent = pdoc.entity(ent_id)
-                    records[ent_id] = ent
+                    new_ns = ent_id.partition(":")[0]
+                    if new_ns not in namespaces:
+                        pdoc.add_namespace(new_ns, new_ns + ":")
+                        namespaces.add(new_ns)
+                ent = get_or_create(new_entity, ent_id)
                 rol = provdict.pop("used_role", None)
                 # if rol:
                 #     ent.add_attributes({'prov:label': rol})
@@ -130,86 +145,79 @@ def provlist2provdoc(provlist, default_ns=DEFAULT_NS):
             if "generated_id" in provdict:
                 ent_id = str(provdict.pop("generated_id"))
                 if ":" not in ent_id:
-                    ent_id = default_ns + ":" + "_".join([sess_id, ent_id])
-                else:
-                    new_ns = ent_id.split(":").pop(0)
-                    pdoc.add_namespace(new_ns, new_ns + ":")
-                if ent_id in records:
-                    ent = records[ent_id]
+                    ent_id = f"{ns_prefix}{sess_id}_{ent_id}"
                 else:
-                    ent = pdoc.entity(ent_id)
-                    records[ent_id] = ent
+                    new_ns = ent_id.partition(":")[0]
+                    if new_ns not in namespaces:
+                        pdoc.add_namespace(new_ns, new_ns + ":")
+                        namespaces.add(new_ns)
+                ent = get_or_create(new_entity, ent_id)
                 rol = provdict.pop("generated_role", None)
                 # if rol:
                 #     ent.add_attributes({'prov:label': rol})
                 ent.wasGeneratedBy(act, attributes={"prov:role": rol})
-            for k, v in provdict.items():
-                act.add_attributes({k: str(v)})
+            if provdict:
+                act.add_attributes({k: str(v) for k, v in provdict.items()})
         # entity
         if "entity_id" in provdict:
             ent_id = str(provdict.pop("entity_id"))
             label = ""
             if ":" not in ent_id:
-                ent_id = default_ns + ":" + "_".join([sess_id, ent_id])
-            else:
-                new_ns = ent_id.split(":").pop(0)
-                pdoc.add_namespace(new_ns, new_ns + ":")
-            if ent_id in records:
-                ent = records[ent_id]
+                ent_id = f"{ns_prefix}{sess_id}_{ent_id}"
             else:
-                ent = pdoc.entity(ent_id)
-                records[ent_id] = ent
+                new_ns = ent_id.partition(":")[0]
+                if new_ns not in namespaces:
+                    pdoc.add_namespace(new_ns, new_ns + ":")
+                    namespaces.add(new_ns)
+            ent = get_or_create(new_entity, ent_id)
+            # attributes are collected, then added at once
+            attributes = {}
             if "name" in provdict:
                 label = provdict.pop("name")
-                ent.add_attributes({"voprov:name": label})
+                attributes["voprov:name"] = label
             if "entity_description" in provdict:
                 label = provdict.pop("entity_description")
-                ent.add_attributes({"voprov:entity_description": label})
+                attributes["voprov:entity_description"] = label
             if "type" in provdict:
-                ent.add_attributes({"prov:type": provdict.pop("type")})
+                attributes["prov:type"] = provdict.pop("type")
             if "value" in provdict:
-                value_short = str(provdict.pop("value"))[:20]
-                if len(value_short) == 20:
-                    value_short += "..."
-                ent.add_attributes({"prov:value": value_short})
+                attributes["prov:value"] = _shorten(provdict.pop("value"))
             if "location" in provdict:
                 location = str(provdict.pop("location"))
-                ent.add_attributes({"prov:location": location})
+                attributes["prov:location"] = location
                 if label:
                     label = label + " in " + location
             if label:
-                ent.add_attributes({"prov:label": label})
+                attributes["prov:label"] = label
             if "generated_time" in provdict:
-                ent.add_attributes({"prov:generatedAtTime": str(provdict.pop("generated_time"))})
+                attributes["prov:generatedAtTime"] = str(provdict.pop("generated_time"))
             # member
             if "member_id" in provdict:
                 mem_id = str(provdict.pop("member_id"))
                 if ":" not in mem_id:
-                    mem_id = default_ns + ":" + "_".join([sess_id, mem_id])
+                    mem_id = f"{ns_prefix}{sess_id}_{mem_id}"
                 else:
-                    new_ns = mem_id.split(":").pop(0)
-                    pdoc.add_namespace(new_ns, new_ns + ":")
-                if mem_id in records:
-                    mem = records[mem_id]
-                else:
-                    mem = pdoc.entity(mem_id)
-                    records[mem_id] = mem
+                    new_ns = mem_id.partition(":")[0]
+                    if new_ns not in namespaces:
+                        pdoc.add_namespace(new_ns, new_ns + ":")
+                        namespaces.add(new_ns)
+                mem = get_or_create(new_entity, mem_id)
                 ent.hadMember(mem)
             if "progenitor_id" in provdict:
                 progen_id = str(provdict.pop("progenitor_id"))
                 if ":" not in progen_id:
-                    progen_id = default_ns + ":" + "_".join([sess_id, progen_id])
+                    progen_id = f"{ns_prefix}{sess_id}_{progen_id}"
                 else:
-                    new_ns = progen_id.split(":").pop(0)
-                    pdoc.add_namespace(new_ns, new_ns + ":")
-                if progen_id in records:
-                    progen = records[progen_id]
-                else:
-                    progen = pdoc.entity(progen_id)
-                    records[progen_id] = progen
+                    new_ns = progen_id.partition(":")[0]
+                    if new_ns not in namespaces:
+                        pdoc.add_namespace(new_ns, new_ns + ":")
+                        namespaces.add(new_ns)
+                progen = get_or_create(new_entity, progen_id)
                 ent.wasDerivedFrom(progen)
             for k, v in provdict.items():
-                ent.add_attributes({k: str(v)})
+                attributes[k] = str(v)
+            if attributes:
+                ent.add_attributes(attributes)
         # agent
     return pdoc
 
@@ -221,41 +229,136 @@ def provdoc2svg(provdoc, filename,
     from voprov.visualization.dot import prov_to_dot
     from pydotplus.graphviz import InvocationException
 
-    try:
-        dot = prov_to_dot(
-            provdoc,
-            use_labels=use_labels,
-            show_element_attributes=show_element_attributes,
-            show_relation_attributes=show_relation_attributes,
-        )
-        svg_content = dot.create(format="svg")
-    except InvocationException as e:
-        svg_content = ""
-        print(f"problem while creating svg content: {repr(e)}")
+    # an unchanged document is not rendered again by graphviz
+    digest = hashlib.blake2b(provdoc.get_provn().encode()).digest()
+    key = (digest, use_labels, show_element_attributes, show_relation_attributes)
+    svg_content = _svg_cache.get(key)
+    if svg_content is not None:
+        _svg_cache.move_to_end(key)
+    else:
+        try:
+            dot = prov_to_dot(
+                provdoc,
+                use_labels=use_labels,
+                show_element_attributes=show_element_attributes,
+                show_relation_attributes=show_relation_attributes,
+            )
+            svg_content = dot.create(format="svg")
+            _svg_cache[key] = svg_content
+            if len(_svg_cache) > SVG_CACHE_SIZE:
+                _svg_cache.popitem(last=False)
+        except InvocationException as e:
+            svg_content = ""
+            print(f"problem while creating svg content: {repr(e)}")
     with open(filename, "wb") as f:
         f.write(svg_content)
 
 
+def _iso_key(date_str):
+    """ Return a date in ISO format with microseconds, so that dates compare as strings"""
+    if len(date_str) == ISO_DATE_LENGTH:
+        # already YYYY-MM-DDTHH:MM:SS.ffffff, as written by ProvCapture
+        return date_str
+    return datetime.datetime.fromisoformat(date_str).isoformat(timespec="microseconds")
+
+
+def _parse_record(prov_str):
+    """ Parse a provenance record of the log (JSON, or yaml for older logs)"""
+    try:
+        return json.loads(prov_str)
+    except ValueError:
+        # logs written before records were JSON
+        return _get_yaml_load()(prov_str)
+
+
 def read_prov(logname="prov.log", start=None, end=None, prefix=PROV_PREFIX):
     """ Read a list of provenance dictionaries from the structured log"""
+    # the dates of the records are compared as strings, they are not parsed
     if start:
-        start_dt = datetime.datetime.fromisoformat(start)
+        start = _iso_key(start)
     if end:
-        end_dt = datetime.datetime.fromisoformat(end)
+        end = _iso_key(end)
     prov_list = []
+    append = prov_list.append
     with open(logname, "r") as f:
-        for l in f.readlines():
+        # lines are read one at a time, the whole log is never held in memory
+        for l in f:
             ll = l.split(prefix)
             if len(ll) >= 2:
                 prov_str = ll.pop()
-                prov_dt = datetime.datetime.fromisoformat(ll.pop())
                 keep = True
-                if prov_dt:
-                    if start and prov_dt < start_dt:
+                if start or end:
+                    prov_dt = _iso_key(ll.pop())
+                    if start and prov_dt < start:
                         keep = False
-                    if end and prov_dt > end_dt:
+                    if end and prov_dt > end:
                         keep = False
                 if keep:
-                    prov_dict = yaml.safe_load(prov_str)
-                    prov_list.append(prov_dict)
+                    append(_parse_record(prov_str))
     return prov_list
+
+
+def _next_record_date(f, offset, prefix):
+    """ Return the position and date of the first record starting after offset in a log opened in binary mode"""
+    f.seek(offset)
+    if offset:
+        # skip the end of the line containing offset
+        f.readline()
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            return position, None
+        ll = line.split(prefix)
+        if len(ll) >= 3:
+            return position, _iso_key(ll[-2].decode())
+
+
+def read_prov_range(logname="prov.log", start=None, end=None, prefix=PROV_PREFIX):
+    """ Read a list of provenance dictionaries from a structured log whose records are in chronological order
+
+    The first record after start is found by bisection on the file offsets, and reading stops at the first record
+    after end, so only the records of the range are read.
+    """
+    if start:
+        start = _iso_key(start)
+    if end:
+        end = _iso_key(end)
+    prefix_bytes = prefix.encode()
+    prov_list = []
+    append = prov_list.append
+    with open(logname, "rb") as f:
+        position = 0
+        if start:
+            low, high = 0, os.fstat(f.fileno()).st_size
+            while low < high:
+                middle = (low + high) // 2
+                prov_dt = _next_record_date(f, middle, prefix_bytes)[1]
+                if prov_dt is None or prov_dt >= start:
+                    high = middle
+                else:
+                    low = middle + 1
+            position = _next_record_date(f, low, prefix_bytes)[0]
+        f.seek(position)
+        for l in f:
+            ll = l.split(prefix_bytes)
+            if len(ll) >= 2:
+                prov_str = ll.pop().decode()
+                if end and _iso_key(ll.pop().decode()) > end:
+                    break
+                append(_parse_record(prov_str))
+    return prov_list
+
+
+def provlist2provfile(provlist, filename):
+    """ Write a list of provenance dictionaries to a file, one JSON record per line"""
+    with open(filename, "w") as f:
+        for prov_dict in provlist:
+            f.write(json.dumps(prov_dict, default=str))
+            f.write("\n")
+
+
+def provfile2provlist(filename):
+    """ Read a list of provenance dictionaries from a file written by provlist2provfile"""
+    with open(filename, "r") as f:
+        return [json.loads(l) for l in f if l.strip()]
@@ -0,0 +1,41 @@
+import copy
+
+import pytest
+
+from logprov.capture import ProvCapture, logprov_default_config, definitions_default
+from logprov.io import read_prov
+
+
+@pytest.fixture
+def log_filename(tmp_path):
+    return str(tmp_path / "prov.log")
+
+
+@pytest.fixture
+def new_capture(log_filename):
+    """Return a function that creates a ProvCapture writing to a temporary log"""
+
+    def new_capture(definitions=None, **config):
+        prov_config = copy.deepcopy(logprov_default_config)
+        prov_config["log_filename"] = log_filename
+        prov_config.update(config)
+        prov_definitions = copy.deepcopy(definitions_default)
+        for key, value in (definitions or {}).items():
+            prov_definitions[key].update(value)
+        prov_capture = ProvCapture(definitions=prov_definitions, config=prov_config)
+        prov_capture.logger.setLevel("INFO")
+        return prov_capture
+
+    return new_capture
+
+
+@pytest.fixture
+def read_log(log_filename):
+    """Return a function that flushes the logger of a capture and reads its log"""
+
+    def read_log(prov_capture):
+        for handler in prov_capture.logger.handlers:
+            handler.flush()
+        return read_prov(logname=log_filename)
+
+    return read_log
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+
+def activity_names(provlist):
+    return [r["name"] for r in provlist if "activity_id" in r and "startTime" in r]
+
+
+def test_nested_activity(new_capture, read_log):
+    definitions = {
+        "entity_descriptions": {"Value": {"type": "PythonObject"}},
+        "activity_descriptions": {
+            "outer": {
+                "generation": [{"role": "value", "entity_description": "Value", "value": "helper.get_value()"}]
+            },
+        },
+    }
+    prov_capture = new_capture(definitions)
+
+    @prov_capture.trace_methods
+    class Helper:
+        def get_value(self):
+            return 3
+
+    @prov_capture.trace_methods
+    class Outer:
+        def __init__(self):
+            self.helper = Helper()
+
+        def outer(self, n=0):
+            return n
+
+    assert Outer().outer(n=1) == 1
+    provlist = read_log(prov_capture)
+    # the traced call made while the outer activity is logged does not drop its records
+    assert sorted(activity_names(provlist)) == ["get_value", "outer"]
+    assert sum("session_id" in r for r in provlist) == 1
+    assert sum("endTime" in r for r in provlist) == 2
+
+
+def test_activities_in_threads(new_capture, read_log):
+    prov_capture = new_capture()
+
+    @prov_capture.trace_methods
+    class Worker:
+        def work(self, n=0):
+            return n
+
+    def run():
+        worker = Worker()
+        for i in range(50):
+            worker.work(n=i)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    provlist = read_log(prov_capture)
+    assert activity_names(provlist) == ["work"] * 200
+    assert sum("endTime" in r for r in provlist) == 200
+
+
+def test_traced_variables_view(new_capture):
+    definitions = {
+        "entity_descriptions": {"Value": {"type": "PythonObject"}},
+        "activity_descriptions": {
+            "set_value": {
+                "generation": [{"role": "value", "entity_description": "Value", "value": "value"}]
+            },
+        },
+    }
+    prov_capture = new_capture(definitions)
+
+    @prov_capture.trace_methods
+    class Holder:
+        def set_value(self, value=0):
+            self.value = value
+
+    holder = Holder()
+    holder.set_value(value=1)
+    traced_variables = prov_capture.traced_variables
+    traced_variable = traced_variables["value"]
+    first_id = traced_variable["last_id"]
+    holder.set_value(value=2)
+    # the view follows the updates of the capture
+    assert traced_variable["last_id"] != first_id
+    assert traced_variables["value"]["previous_ids"] == [first_id, traced_variable["last_id"]]
+    with pytest.raises(TypeError):
+        traced_variables["value"] = {}
+    # assigning a view of the traced variables keeps them
+    prov_capture.traced_variables = traced_variables
+    assert prov_capture.traced_variables["value"]["previous_ids"] == [first_id, traced_variable["last_id"]]
@@ -1,5 +1,6 @@
 import logprov.capture
-from logprov.io import read_prov, provlist2provdoc, provdoc2svg
+from logprov.io import read_prov, read_prov_range, provlist2provdoc, provdoc2svg
+from logprov.io import provlist2provfile, provfile2provlist
 import yaml
 import datetime
 from shutil import copyfile
@@ -93,7 +94,9 @@ agents:
 definitions = yaml.safe_load(definitions_yaml)
 # definitions = logprov.capture.definitions_default
 
-prov_capture = logprov.ProvCapture(definitions=definitions, config=provconfig)
+prov_capture = logprov.get_capture(definitions=definitions, config=provconfig)
+# the capture is shared: later calls return the same instance
+assert logprov.get_capture() is prov_capture
 prov_capture.traced_variables = {}
 prov_capture.logger.setLevel("DEBUG")
 
@@ -181,6 +184,10 @@ print(start, "-->", end)
 
 logname = provconfig['log_filename']
 provlist = read_prov(logname=logname, start=start, end=end)
+# the log is written in chronological order: the range can be read by bisection
+assert read_prov_range(logname=logname, start=start, end=end) == provlist
+provlist2provfile(provlist, logname + '.jsonl')
+assert provfile2provlist(logname + '.jsonl') == provlist
 provdoc = provlist2provdoc(provlist)
 # for pr in provdoc.get_records():
 #     print(pr.get_provn())
@@ -0,0 +1,38 @@
+import copy
+
+import pytest
+
+from logprov import capture
+from logprov.capture import get_capture, logprov_default_config
+
+
+@pytest.fixture
+def shared_capture(monkeypatch, tmp_path):
+    """Create the shared capture in a temporary log, and remove it after the test"""
+    monkeypatch.setattr(capture, "_capture_instance", None)
+    monkeypatch.setattr(capture, "_capture_args", None)
+    config = copy.deepcopy(logprov_default_config)
+    config["log_filename"] = str(tmp_path / "prov.log")
+    return get_capture(config=config), config
+
+
+def test_get_capture_shared(shared_capture, recwarn):
+    prov_capture, config = shared_capture
+    assert get_capture() is prov_capture
+    assert get_capture(config=config) is prov_capture
+    assert not recwarn
+
+
+def test_get_capture_other_args(shared_capture, tmp_path):
+    prov_capture, config = shared_capture
+    other_config = dict(config, log_filename=str(tmp_path / "other.log"))
+    with pytest.warns(UserWarning, match="ignored"):
+        assert get_capture(config=other_config) is prov_capture
+    assert prov_capture.config["log_filename"] == config["log_filename"]
+
+
+def test_log_filename_not_shared(new_capture, tmp_path):
+    prov_capture = new_capture(log_filename=str(tmp_path / "first.log"))
+    # the log file of an instance does not become the default of the next ones
+    assert prov_capture.logging_dict is not capture.logging_default_config
+    assert capture.logging_default_config["handlers"]["provHandler"]["filename"] == "prov.log"
@@ -0,0 +1,82 @@
+import hashlib
+import os
+
+import pytest
+
+from logprov import capture
+
+definitions = {
+    "entity_descriptions": {
+        "DataFile": {"type": "File"},
+    },
+}
+
+
+def write_file(path, content, mtime_ns):
+    path.write_text(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def reference_hash(method, content):
+    if method == "blake2b":
+        return hashlib.blake2b(content, digest_size=20).hexdigest()
+    if method == "blake3":
+        return pytest.importorskip("blake3").blake3(content).hexdigest()
+    if method == "xxh3_128":
+        return pytest.importorskip("xxhash").xxh3_128_hexdigest(content)
+    return hashlib.new(method, content).hexdigest()
+
+
+@pytest.mark.parametrize("method", capture.SUPPORTED_HASH_TYPE)
+@pytest.mark.parametrize("content", [b"", b"logprov" * 1000])
+def test_hash_methods(new_capture, tmp_path, method, content):
+    expected = reference_hash(method, content)
+    prov_capture = new_capture(hash_type=method.upper())
+    assert prov_capture.get_hash_method() == method
+    path = tmp_path / "data.bin"
+    path.write_bytes(content)
+    assert prov_capture.get_file_hash(str(path)) == expected
+
+
+def test_hash_method_not_supported(new_capture, tmp_path):
+    prov_capture = new_capture(hash_type="crc32")
+    assert prov_capture.get_hash_method() == "Full path"
+    assert prov_capture.get_file_hash(str(tmp_path / "data.bin")) == str(tmp_path / "data.bin")
+
+
+def test_hash_cache(new_capture, tmp_path, monkeypatch):
+    prov_capture = new_capture()
+    path = tmp_path / "data.txt"
+    write_file(path, "first", 1_000_000_000)
+    assert prov_capture.get_file_hash(str(path)) == hashlib.sha256(b"first").hexdigest()
+    # a file that is not modified is not hashed again
+    monkeypatch.setattr(prov_capture, "_hash_file", None)
+    assert prov_capture.get_file_hash(str(path)) == hashlib.sha256(b"first").hexdigest()
+    monkeypatch.undo()
+    write_file(path, "second", 2_000_000_000)
+    assert prov_capture.get_file_hash(str(path)) == hashlib.sha256(b"second").hexdigest()
+
+
+def test_hash_files_not_stale(new_capture, tmp_path):
+    prov_capture = new_capture(definitions=definitions, parallel_hash=True)
+    paths = [tmp_path / "a.txt", tmp_path / "b.txt"]
+    for path in paths:
+        write_file(path, "first", 1_000_000_000)
+    item_descriptions = [{"entity_description": "DataFile"}] * len(paths)
+    prov_capture.hash_files(item_descriptions, [({}, str(path)) for path in paths])
+    assert prov_capture.get_file_hash(str(paths[0])) == hashlib.sha256(b"first").hexdigest()
+    # a file modified after being hashed in advance is hashed again
+    write_file(paths[0], "second", 2_000_000_000)
+    assert prov_capture.get_file_hash(str(paths[0])) == hashlib.sha256(b"second").hexdigest()
+    assert prov_capture.get_file_hash(str(paths[1])) == hashlib.sha256(b"first").hexdigest()
+
+
+def test_file_caches_bounded(new_capture, tmp_path, monkeypatch):
+    monkeypatch.setattr(capture, "FILE_HASH_CACHE_SIZE", 4)
+    prov_capture = new_capture(definitions=definitions)
+    for i in range(10):
+        path = tmp_path / f"{i}.txt"
+        path.write_text(str(i))
+        prov_capture.log_file_generation(str(path), entity_description="DataFile")
+    assert len(prov_capture._file_hash_cache) == 4
+    assert len(prov_capture._entity_id_cache) == 4
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from logprov.io import read_prov, read_prov_range
+
+dates = [f"2024-01-0{day}T12:00:00.000000" for day in range(1, 6)]
+
+
+@pytest.fixture
+def dated_log(tmp_path):
+    """Log with a record per date, and lines that are not records"""
+    log_filename = tmp_path / "prov.log"
+    lines = ["WARNING Not a record"]
+    for i, date in enumerate(dates):
+        lines.append(f"INFO _PROV_{date}_PROV_" + json.dumps({"entity_id": i}))
+        lines.append(f"DEBUG Line {i}")
+    log_filename.write_text("\n".join(lines) + "\n")
+    return str(log_filename)
+
+
+@pytest.mark.parametrize("start", [None, "2023-12-31", dates[0], "2024-01-03T06:00:00", dates[4], "2024-01-06"])
+@pytest.mark.parametrize("end", [None, "2023-12-31", dates[0], "2024-01-03T06:00:00", dates[4], "2024-01-06"])
+def test_read_prov_range(dated_log, start, end):
+    expected = [
+        {"entity_id": i}
+        for i, date in enumerate(dates)
+        if (not start or date >= start) and (not end or date <= end)
+    ]
+    assert read_prov(logname=dated_log, start=start, end=end) == expected
+    assert read_prov_range(logname=dated_log, start=start, end=end) == expected
+
+
+def test_read_prov_range_empty(tmp_path):
+    log_filename = tmp_path / "prov.log"
+    log_filename.write_text("")
+    assert read_prov_range(logname=str(log_filename), start=dates[0]) == []
+    assert read_prov(logname=str(log_filename)) == []
+
+
+def test_read_prov_legacy(tmp_path):
+    # records written before they were JSON
+    log_filename = tmp_path / "prov.log"
+    log_filename.write_text(
+        f"INFO _PROV_{dates[0]}_PROV_{{'entity_id': 1, 'location': 'data.fits'}}\n"
+        f"INFO _PROV_{dates[1]}_PROV_" + json.dumps({"entity_id": 2}) + "\n"
+    )
+    expected = [{"entity_id": 1, "location": "data.fits"}, {"entity_id": 2}]
+    assert read_prov(logname=str(log_filename)) == expected
+    assert read_prov_range(logname=str(log_filename), start=dates[0]) == expected
+    assert read_prov_range(logname=str(log_filename), start=dates[1]) == expected[1:]
@@ -0,0 +1,71 @@
+import atexit
+import datetime
+import logging.handlers
+
+import pytest
+
+from logprov.capture import _get_record_serializer, _json_dumps
+from logprov.io import read_prov
+
+recursive_list = [1]
+recursive_list.append(recursive_list)
+
+
+@pytest.mark.parametrize("prov_dict, expected", [
+    ({"entity_id": 1, "value": "é"}, '{"entity_id":1,"value":"é"}'),
+    ({"date": datetime.date(2024, 1, 1)}, '{"date":"2024-01-01"}'),
+    ({"value": {1, }}, '{"value":"{1}"}'),
+    ({1: "a"}, '{"1":"a"}'),
+    # values rejected by orjson are serialized by json, with the same format
+    ({"value": 1 << 70}, '{"value":1180591620717411303424}'),
+    ({(1, 2): "a"}, '{"(1, 2)":"a"}'),
+    ({"value": recursive_list}, '{"value":"[1, [...]]"}'),
+])
+def test_serializer(prov_dict, expected):
+    assert _get_record_serializer()(prov_dict) == expected
+    assert _json_dumps(prov_dict) == expected
+
+
+def test_dedupe_members(new_capture, read_log):
+    prov_capture = new_capture(definitions={"entity_descriptions": {"Value": {"type": "PythonObject"}}})
+    subitem = {"list": "items", "entity_description": "Value", "value": "name"}
+    prov_capture.log_members(1230, subitem, {"items": [{"name": "a"}, {"name": "a"}, {"name": "b"}]})
+    provlist = read_log(prov_capture)
+    # an entity listed twice is logged once, but its membership is logged for each occurrence
+    assert [r["value"] for r in provlist if "value" in r] == ["a", "b"]
+    assert sum("member_id" in r for r in provlist) == 3
+
+
+@pytest.mark.parametrize("dedupe_used, expected", [(False, 3), (True, 2)])
+def test_dedupe_used(new_capture, read_log, tmp_path, dedupe_used, expected):
+    prov_capture = new_capture(
+        definitions={"entity_descriptions": {"DataFile": {"type": "File"}}}, dedupe_used=dedupe_used
+    )
+    path = tmp_path / "data.txt"
+    path.write_text("data")
+    prov_capture.log_file_generation(str(path), "DataFile", used=["x", "x", "y"])
+    prov_capture.log_file_generation(str(path), "DataFile", used=["x", "x", "y"], activity_name="write")
+    provlist = read_log(prov_capture)
+    assert sum("progenitor_id" in r for r in provlist) == expected
+    assert sum("used_id" in r for r in provlist) == expected
+
+
+def test_log_in_background(new_capture, log_filename):
+    prov_capture = new_capture(log_in_background=True)
+    assert isinstance(prov_capture.logger.handlers[0], logging.handlers.QueueHandler)
+
+    @prov_capture.trace_methods
+    class Worker:
+        def work(self, n=0):
+            return n
+
+    worker = Worker()
+    for i in range(100):
+        worker.work(n=i)
+    # wait for the records to be written (instead of at exit)
+    listener = prov_capture._queue_listener
+    listener.stop()
+    atexit.unregister(listener.stop)
+    provlist = read_prov(logname=log_filename)
+    parameters = [r["parameters"]["kwargs.n"] for r in provlist if "parameters" in r]
+    assert parameters == list(range(100))
@@ -0,0 +1,28 @@
+def activity_names(provlist):
+    return [r["name"] for r in provlist if "activity_id" in r and "startTime" in r]
+
+
+def test_set_capture(new_capture, read_log):
+    prov_capture = new_capture(capture=False)
+
+    @prov_capture.trace_methods
+    class Worker:
+        def work(self, n=0):
+            return n
+
+    @prov_capture.trace
+    def compute(n=0):
+        return n
+
+    worker = Worker()
+    assert worker.work(n=1) == 1
+    assert compute(n=1) == 1
+    assert read_log(prov_capture) == []
+    # classes and functions decorated while capture was disabled are traced once it is enabled
+    prov_capture.set_capture(True)
+    assert worker.work(n=2) == 2
+    assert compute(n=2) == 2
+    assert activity_names(read_log(prov_capture)) == ["work", "compute"]
+    prov_capture.set_capture(False)
+    assert compute(n=3) == 3
+    assert len(activity_names(read_log(prov_capture))) == 2
@@ -0,0 +1,9 @@
+def test_system_provenance_not_shared(new_capture):
+    prov_capture = new_capture()
+    system = prov_capture.get_system_provenance()
+    system["platform"]["node"] = "modified"
+    system["python"].clear()
+    # the system provenance computed once for the process is not modified by the callers
+    other_system = prov_capture.get_system_provenance()
+    assert other_system["platform"]["node"] != "modified"
+    assert other_system["python"]